@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+
+from io_utils import save_json_atomic
+
+# Append-only storage of the annotations of a user.
+# Every session, chunk and answer of `manymusic-annotator.py` is appended as one JSON
+# line to `journal.jsonl` and fsynced, so a click costs a constant-size write. The
+# journal is periodically compacted into `annotations.json`, which keeps the layout
+# read by the analysis scripts. Replaying a record twice is a no-op, so a crash
+# between writing `annotations.json` and truncating the journal loses nothing, and a
+# record truncated by a crash is dropped on load.
+
+ANNOTATIONS_FILE = "annotations.json"
+JOURNAL_FILE = "journal.jsonl"
+
+# number of appended records between two compactions
+COMPACT_EVERY = 100
+
+# number of users whose annotations are kept in memory by a server
+MAX_USERS = 32
+
+
+def apply_record(user_data: dict, record: dict) -> None:
+    """Apply a journal record to the user data."""
+
+    if record["type"] == "session":
+        session = {k: record[k] for k in ("start", "end", "chunk", "uuid")}
+        if not any(s["start"] == session["start"] for s in user_data["sessions"]):
+            user_data["sessions"].append(session)
+
+    elif record["type"] == "chunk":
+        if record["chunk"] not in user_data["annotations"]:
+            user_data["annotations"][record["chunk"]] = {
+                str(k): dict() for k in record["tids"]
+            }
+
+    elif record["type"] == "answer":
+        user_data["annotations"][record["chunk"]][record["tid"]] = {
+            "answer": record["answer"],
+            "timestamp": record["timestamp"],
+        }
+        if user_data["sessions"]:
+            session = user_data["sessions"][-1]
+            session["end"] = max(session["end"], record["timestamp"])
+
+    else:
+        raise ValueError(f"Invalid journal record type: {record['type']}")
+
+
+class AnnotationJournal:
+    """Annotations of a user, stored in `user_dir`.
+
+    The journal can be shared by several sessions of the user, `lock` serializes its
+    updates.
+    """
+
+    def __init__(self, user_dir: Path, compact_every: int = COMPACT_EVERY):
+        self.user_dir = Path(user_dir)
+        self.annotations_file = self.user_dir / ANNOTATIONS_FILE
+        self.journal_file = self.user_dir / JOURNAL_FILE
+        self.compact_every = compact_every
+        self.lock = threading.RLock()
+
+        self.user_data = self.load()
+        self.n_records = 0
+
+    def load(self) -> dict:
+        """Return the compacted annotations updated with the records of the journal."""
+
+        if self.annotations_file.exists():
+            with open(self.annotations_file, "r") as f:
+                user_data = json.load(f)
+        else:
+            user_data = {"annotations": dict(), "sessions": []}
+
+        if not self.journal_file.exists():
+            return user_data
+
+        with open(self.journal_file, "rb") as f:
+            journal = f.read()
+
+        # drop a last record left incomplete by a crash, so the next one is not
+        # appended to it
+        complete = journal.rfind(b"\n") + 1
+        if complete < len(journal):
+            print(f"Dropping an incomplete record of {self.journal_file}")
+            os.truncate(self.journal_file, complete)
+
+        for line in journal[:complete].splitlines():
+            apply_record(user_data, json.loads(line))
+
+        return user_data
+
+    def append(self, record: dict) -> None:
+        """Apply a record and append it durably to the journal."""
+
+        with self.lock:
+            apply_record(self.user_data, record)
+
+            self.user_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.journal_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.n_records += 1
+            if self.n_records >= self.compact_every:
+                self.compact()
+
+    def compact(self) -> None:
+        """Save the annotations to `annotations.json` and empty the journal."""
+
+        with self.lock:
+            save_json_atomic(self.annotations_file, self.user_data)
+            # the records are already in `annotations.json`, replaying them is a no-op
+            self.journal_file.unlink(missing_ok=True)
+            self.n_records = 0
+
+    def start_session(self, chunk: str, uuid: str) -> None:
+        now = datetime.now().isoformat()
+        self.append(
+            {"type": "session", "start": now, "end": now, "chunk": chunk, "uuid": uuid}
+        )
+
+    def add_chunk(self, chunk: str, tids: list) -> None:
+        """Initialise the annotations of a chunk, unless it was already started."""
+
+        with self.lock:
+            if chunk not in self.user_data["annotations"]:
+                self.append({"type": "chunk", "chunk": chunk, "tids": tids})
+
+    def record_answer(self, chunk: str, tid: str, answer: str) -> None:
+        self.append(
+            {
+                "type": "answer",
+                "chunk": chunk,
+                "tid": tid,
+                "answer": answer,
+                "timestamp": datetime.now().isoformat(),
+            }
+        )
+
+
+class JournalCache:
+    """LRU cache of the journals of the users, shared by the sessions of a server.
+
+    Every session of a user gets the same journal, so their updates do not overwrite
+    each other. The `max_users` most recent journals are kept in memory, and an
+    evicted journal stays the one returned as long as a session still references it,
+    so a user never has two journals. Otherwise, it is replayed on its next use.
+    """
+
+    def __init__(self, max_users: int = MAX_USERS):
+        self.max_users = max_users
+        self.journals = OrderedDict()
+        # every journal alive, including the evicted ones still referenced
+        self.live_journals = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    def get(self, user_dir: Path) -> AnnotationJournal:
+        key = str(user_dir)
+        with self.lock:
+            journal = self.live_journals.get(key)
+            if journal is None:
+                journal = AnnotationJournal(user_dir)
+                self.live_journals[key] = journal
+            self.journals[key] = journal
+
+            self.journals.move_to_end(key)
+            while len(self.journals) > self.max_users:
+                self.journals.popitem(last=False)
+
+            return journal
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Compact the annotation journals of all the users into their "
+        "`annotations.json`."
+    )
+    parser.add_argument("annotations_dir", type=Path, nargs="?", default="annotations")
+    args = parser.parse_args()
+
+    for journal_file in sorted(args.annotations_dir.glob(f"*/{JOURNAL_FILE}")):
+        print(f"Compacting {journal_file}")
+        AnnotationJournal(journal_file.parent).compact()
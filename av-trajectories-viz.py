@@ -1,8 +1,6 @@
-import cmathimport
 import pickle as pk
 from collections import Counter, defaultdict
 from pathlib import Path
-import sys
 
 import numpy as np
 import pandas as pd
@@ -12,12 +10,14 @@ import seaborn as sns
 import streamlit as st
 from scipy.ndimage import gaussian_filter1d
 
+from utils import load_av_time_data
+from av_store import AV_STORE_DIR
+from tracks_table import AUDIO_PREVIEW_SECONDS, load_tracks
+
 
 aspects = ("arousal", "valence")
 traject_types = ("ascending", "descending", "peaks")
 
-sys.path.append("mtg-jamendo-dataset/scripts/")
-import commons
 
 data_dir = Path("data/")
 
@@ -28,7 +28,10 @@ av_predictions_dir = (
 
 
 def audio_url(trackid):
-    return f"https://mp3d.jamendo.com/?trackid={trackid}&format=mp32#t=0,120"
+    return (
+        f"https://mp3d.jamendo.com/?trackid={trackid}&format=mp32"
+        f"#t=0,{AUDIO_PREVIEW_SECONDS}"
+    )
 
 
 st.write(
@@ -39,51 +42,46 @@ st.write(
 )
 
 
-@st.cache_data
-def load_data():
-    # load and prepare groundtruth
-    data_models = pd.read_csv(
-        data_dir / "mtg-jamendo-predictions.tsv", sep="\t", index_col=0
-    )
-    data_av = pd.read_pickle(data_dir / "mtg-jamendo-predictions-av.pk")
-    data_algos = pd.read_pickle(data_dir / "mtg-jamendo-predictions-algos.pk")
-
-    data = pd.concat([data_models, data_av, data_algos], axis=1)
-    data.index = pd.Index(map(lambda x: int(x.split("/")[1]), data.index))
+@st.cache_resource
+def load_tracks_cached():
+    """Load the MTG Jamendo tracks table once per server."""
 
-    mtg_jamendo_file = "mtg-jamendo-dataset/data/autotagging.tsv"
-    tracks, _, _ = commons.read_file(mtg_jamendo_file)
-    return data, tracks
+    return load_tracks()
 
 
-data, tracks = load_data()
+tracks = load_tracks_cached()
 tids_init = set(tracks.keys())
 tids_clean = tids_init
 
 
-@st.cache_data
-def load_av_time_data():
-    data_av_time = dict()
+@st.cache_resource
+def load_av_time_data_cached():
+    """Memory-map the AV predictions once per server.
+
+    The views are shared by all the reruns and sessions instead of being copied.
+    """
+
     pbar_av_time = st.progress(0.0, text="Loading AV predictions")
-    tids_clean_list = list(tids_clean)
-    for i, index in enumerate(tids_clean_list):
-        try:
-            av_filename = (av_predictions_dir / tracks[index]["path"]).with_suffix(
-                ".npy"
-            )
-            # load and normalize
-            data_av_time[index] = (np.load(av_filename) - 5) / 4
-        except Exception:
-            pass
-        pbar_av_time.progress((i + 1) / len(tids_clean_list))
+    data_av_time, report = load_av_time_data(
+        tids_clean,
+        tracks,
+        av_predictions_dir,
+        store_dir=AV_STORE_DIR,
+        progress_callback=lambda n_done, n_total: pbar_av_time.progress(
+            n_done / n_total
+        ),
+    )
     pbar_av_time.empty()
 
-    st.write(f"Loaded {len(data_av_time)} AV predictions")
+    st.write(
+        f"Loaded {len(data_av_time)} AV predictions "
+        f"({len(report['missing'])} missing, {len(report['corrupt'])} corrupt)"
+    )
 
     return data_av_time
 
 
-data_av_time = load_av_time_data()
+data_av_time = load_av_time_data_cached()
 
 tids_clean = set(data_av_time.keys())
 
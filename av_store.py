@@ -0,0 +1,356 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+# Packed storage of the time-wise arousal and valence predictions.
+# All trajectories are concatenated into one contiguous float32 array and indexed by
+# tid -> (offset, length), so loading them costs one memory-mapped file instead of one
+# `np.load` per track.
+
+TRAJECTORIES_FILE = "trajectories.npy"
+INDEX_FILE = "index.npy"
+META_FILE = "meta.json"
+
+PREPROCESSED_CACHE_DIR = Path("data/cache/preprocessed/")
+
+AV_PREDICTIONS_DIR = Path("data/predictions/emomusic-msd-musicnn-2/")
+
+
+def packed_store_dir(av_predictions_dir: Path) -> Path:
+    """Return the location of the packed store for a predictions directory."""
+
+    av_predictions_dir = Path(av_predictions_dir)
+    return av_predictions_dir.with_name(av_predictions_dir.name + "-packed")
+
+
+# the store built by `python av_store.py`
+AV_STORE_DIR = packed_store_dir(AV_PREDICTIONS_DIR)
+
+
+def has_av_store(store_dir: Path) -> bool:
+    """Check whether a complete packed store exists in `store_dir`."""
+
+    store_dir = Path(store_dir)
+    return all(
+        (store_dir / name).exists() for name in (TRAJECTORIES_FILE, INDEX_FILE, META_FILE)
+    )
+
+
+def _build_index(data: dict) -> np.ndarray:
+    """Return the (tid, offset, length) rows of a store holding `data`, sorted by tid."""
+
+    tids = np.array(sorted(data.keys()), dtype=np.int64)
+    lengths = np.array([len(data[tid]) for tid in tids], dtype=np.int64)
+    offsets = np.zeros(len(tids), dtype=np.int64)
+    if len(tids):
+        offsets[1:] = np.cumsum(lengths)[:-1]
+
+    return np.stack([tids, offsets, lengths], axis=1)
+
+
+def write_av_store(data: dict, store_dir: Path, extra_meta: dict = None) -> str:
+    """Write a dict of tid -> trajectory arrays as a packed store.
+
+    Returns the version of the store, a hash of its index and contents.
+    """
+
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    index = _build_index(data)
+    lengths = index[:, 2]
+    n_dims = data[index[0, 0]].shape[1] if len(index) else 2
+
+    trajectories = np.lib.format.open_memmap(
+        store_dir / TRAJECTORIES_FILE,
+        mode="w+",
+        dtype=np.float32,
+        shape=(int(lengths.sum()), n_dims),
+    )
+    version = hashlib.blake2b(index.tobytes(), digest_size=16)
+    for tid, offset, length in index:
+        array = np.asarray(data[tid], dtype=np.float32)
+        trajectories[offset : offset + length] = array
+        version.update(array.tobytes())
+    trajectories.flush()
+    del trajectories
+
+    np.save(store_dir / INDEX_FILE, index)
+
+    meta = {
+        "version": version.hexdigest(),
+        "n_tracks": len(index),
+        "n_frames": int(lengths.sum()),
+    }
+    meta.update(extra_meta or dict())
+
+    # write the metadata last, it marks the store as complete
+    with open(store_dir / META_FILE, "w") as f:
+        json.dump(meta, f)
+
+    return meta["version"]
+
+
+def replace_av_store(data: dict, store_dir: Path, extra_meta: dict = None) -> str:
+    """Write a packed store next to `store_dir` and swap it into place.
+
+    The files of a previous store are never rewritten, so processes that have them
+    memory-mapped keep reading the old trajectories, and an interrupted run leaves
+    the previous store as it was. Returns the version of the new store.
+    """
+
+    store_dir = Path(store_dir)
+    store_dir.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_dir = store_dir.with_name(f".{store_dir.name}.{os.getpid()}.tmp")
+    old_dir = store_dir.with_name(f".{store_dir.name}.{os.getpid()}.old")
+    version = write_av_store(data, tmp_dir, extra_meta)
+
+    if store_dir.exists():
+        os.replace(store_dir, old_dir)
+    os.replace(tmp_dir, store_dir)
+    # unlinked files stay readable by the processes that mapped them
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    return version
+
+
+def read_av_store_meta(store_dir: Path) -> dict:
+    """Read the metadata of a packed store."""
+
+    with open(Path(store_dir) / META_FILE, "r") as f:
+        return json.load(f)
+
+
+def load_av_store(store_dir: Path, tids: set = None) -> dict:
+    """Memory-map a packed store and return zero-copy views per tid.
+
+    If `tids` is given, only those present in the store are returned.
+    """
+
+    store_dir = Path(store_dir)
+    trajectories = np.load(store_dir / TRAJECTORIES_FILE, mmap_mode="r")
+    index = np.load(store_dir / INDEX_FILE)
+
+    if tids is not None:
+        index = index[np.isin(index[:, 0], np.fromiter(tids, dtype=np.int64))]
+
+    return {
+        int(tid): trajectories[offset : offset + length]
+        for tid, offset, length in index
+    }
+
+
+def av_data_version(data: dict) -> str:
+    """Hash the tids and contents of a dict of trajectories.
+
+    Gives the same version as `write_av_store` for the same data.
+    """
+
+    index = _build_index(data)
+
+    version = hashlib.blake2b(index.tobytes(), digest_size=16)
+    for tid in index[:, 0]:
+        version.update(np.asarray(data[tid], dtype=np.float32).tobytes())
+
+    return version.hexdigest()
+
+
+def av_source_version(store_version: str, store_tids: list, file_data: dict) -> str:
+    """Version trajectories read partly from a packed store and partly from files.
+
+    Only the trajectories read from files are hashed, the ones read from the store are
+    identified by the store version and their tids.
+    """
+
+    version = hashlib.blake2b(digest_size=16)
+    if store_tids:
+        version.update(store_version.encode())
+        version.update(np.sort(np.asarray(store_tids, dtype=np.int64)).tobytes())
+    if file_data:
+        version.update(av_data_version(file_data).encode())
+
+    return version.hexdigest()
+
+
+def cache_key(params: dict) -> str:
+    """Return a stable hash for a dict of JSON-serializable parameters."""
+
+    params_str = json.dumps(params, sort_keys=True)
+    return hashlib.blake2b(params_str.encode(), digest_size=16).hexdigest()
+
+
+def load_cached_av_data(params: dict, compute, cache_dir: Path) -> dict:
+    """Return the trajectories cached for `params`, computing them on a miss.
+
+    `compute()` must return a dict of tid -> trajectory. Entries are packed stores
+    named after `cache_key(params)`. Hits refresh the entry's modification time,
+    which `evict_cache` uses as the last access time.
+    """
+
+    cache_dir = Path(cache_dir)
+    entry_dir = cache_dir / cache_key(params)
+
+    if has_av_store(entry_dir):
+        print(f"Loading preprocessed AV data from cache {entry_dir}")
+        os.utime(entry_dir / META_FILE)
+        return load_av_store(entry_dir)
+
+    data = compute()
+
+    # write to a temporary directory and rename it, so that an interrupted run
+    # never leaves a partial entry behind
+    tmp_dir = cache_dir / f".{entry_dir.name}.{os.getpid()}.tmp"
+    write_av_store(data, tmp_dir, extra_meta={"params": params})
+    try:
+        os.replace(tmp_dir, entry_dir)
+    except OSError:
+        # another process filled the same entry in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return load_av_store(entry_dir)
+
+
+def lru_to_evict(
+    entries: list,
+    max_size_bytes: int = None,
+    max_age_days: float = None,
+) -> list:
+    """Select the `(last_access, size, path)` cache entries to evict.
+
+    Returns the paths of the entries not accessed in `max_age_days`, then of the least
+    recently used ones until the others fit in `max_size_bytes`.
+    """
+
+    # least recently used first
+    entries = sorted(entries)
+
+    removed = []
+    if max_age_days is not None:
+        oldest_access = time.time() - max_age_days * 24 * 3600
+        for entry in list(entries):
+            if entry[0] < oldest_access:
+                entries.remove(entry)
+                removed.append(entry[2])
+
+    if max_size_bytes is not None:
+        total_size = sum(size for _, size, _ in entries)
+        while entries and total_size > max_size_bytes:
+            _, size, path = entries.pop(0)
+            total_size -= size
+            removed.append(path)
+
+    return removed
+
+
+def evict_cache(
+    cache_dir: Path,
+    max_size_bytes: int = None,
+    max_age_days: float = None,
+) -> list:
+    """Remove cache entries not accessed in `max_age_days`, then the least recently
+    used ones until the cache fits in `max_size_bytes`.
+
+    Returns the removed entry directories.
+    """
+
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists():
+        return []
+
+    entries = []
+    for entry_dir in cache_dir.iterdir():
+        if not has_av_store(entry_dir):
+            continue
+        last_access = (entry_dir / META_FILE).stat().st_mtime
+        size = sum(f.stat().st_size for f in entry_dir.iterdir())
+        entries.append((last_access, size, entry_dir))
+
+    removed = lru_to_evict(entries, max_size_bytes, max_age_days)
+
+    for entry_dir in removed:
+        print(f"Evicting cache entry {entry_dir}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    return removed
+
+
+def pack_av_time_data(
+    tids: set,
+    tracks: dict,
+    av_predictions_dir: Path,
+    store_dir: Path,
+) -> tuple[str, list]:
+    """Pack the per-track `.npy` predictions into a single store.
+
+    Trajectories are stored normalized to [-1, 1] as returned by `load_av_time_data`.
+    Returns the store version and the list of tids that could not be loaded.
+    """
+
+    data = dict()
+    missing = []
+    for tid in sorted(tids):
+        try:
+            av_filename = (av_predictions_dir / tracks[tid]["path"]).with_suffix(
+                ".npy"
+            )
+            data[tid] = (np.load(av_filename) - 5) / 4
+        except Exception as e:
+            print(f"Could not load AV data for track {tid}: {e}")
+            missing.append(tid)
+
+    version = replace_av_store(
+        data,
+        store_dir,
+        extra_meta={"source": str(av_predictions_dir), "missing": missing},
+    )
+
+    return version, missing
+
+
+if __name__ == "__main__":
+    from tracks_table import load_tracks
+
+    parser = ArgumentParser(
+        description="Pack the time-wise AV predictions into a single memory-mappable store."
+    )
+    parser.add_argument(
+        "--av-predictions-dir",
+        type=Path,
+        default=AV_PREDICTIONS_DIR,
+    )
+    parser.add_argument(
+        "--store-dir",
+        type=Path,
+        default=None,
+        help="Output directory. Defaults to `<av-predictions-dir>-packed`.",
+    )
+    parser.add_argument(
+        "--tids",
+        type=Path,
+        default=None,
+        help="Optional JSON list of tids to pack. Defaults to all the tracks.",
+    )
+    args = parser.parse_args()
+
+    tracks = load_tracks()
+
+    if args.tids:
+        with open(args.tids, "r") as f:
+            tids = set(json.load(f))
+    else:
+        tids = set(tracks.keys())
+
+    store_dir = args.store_dir or packed_store_dir(args.av_predictions_dir)
+    version, missing = pack_av_time_data(
+        tids, tracks, args.av_predictions_dir, store_dir
+    )
+    print(
+        f"Packed {len(tids) - len(missing)} trajectories into {store_dir} (version {version})"
+    )
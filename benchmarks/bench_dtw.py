@@ -0,0 +1,124 @@
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+from tslearn.clustering import TimeSeriesKMeans
+from tslearn.utils import to_time_series_dataset
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils import smooth_data_batched, decimate_data_batched
+from clustering_utils import dtw_metric_params, nearest_series
+from synthetic import make_av_trajectories
+
+# Trade-off between DTW global constraints, LB_Keogh pruning and the clustering
+# results: wall time of the k-means fit and candidate selection, and agreement with
+# the unconstrained DTW run (adjusted Rand index of the labels and overlap of the
+# selected tracks).
+
+
+def run(X: np.ndarray, metric_params: dict, lb_pruning: bool, args) -> dict:
+    """Fit k-means, assign labels and select the tracks closest to each center."""
+
+    start = time.perf_counter()
+    kmeans = TimeSeriesKMeans(
+        n_clusters=args.n_clusters,
+        metric="dtw",
+        metric_params=metric_params,
+        max_iter_barycenter=10,
+        random_state=args.seed,
+    )
+    n_per_cluster = args.n_samples // args.n_clusters
+
+    if lb_pruning:
+        kmeans.fit(X)
+        labels = kmeans.labels_
+        n_dtw = 0
+        selected = set()
+        for center in kmeans.cluster_centers_:
+            indices, _, n_dtw_center = nearest_series(
+                X, center, n_per_cluster, metric_params
+            )
+            selected.update(indices.tolist())
+            n_dtw += n_dtw_center
+    else:
+        distances = kmeans.fit_transform(X)
+        labels = distances.argmin(axis=1)
+        selected = set(np.argsort(distances, axis=0)[:n_per_cluster].ravel().tolist())
+        n_dtw = distances.size
+
+    return {
+        "time": time.perf_counter() - start,
+        "labels": labels,
+        "selected": selected,
+        "n_dtw": n_dtw,
+        "n_iter": kmeans.n_iter_,
+    }
+
+
+parser = ArgumentParser()
+parser.add_argument("--n-tracks", type=int, default=300)
+parser.add_argument("--n-clusters", type=int, default=3)
+parser.add_argument("--n-samples", type=int, default=60)
+parser.add_argument("--radii", type=int, nargs="+", default=[2, 5, 10])
+parser.add_argument("--itakura-max-slope", type=float, default=2.0)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--smoothing-sigma", type=int, default=5)
+parser.add_argument(
+    "--decimate-factor",
+    type=int,
+    default=5,
+    help="Use 1 to benchmark on full-length trajectories.",
+)
+args = parser.parse_args()
+
+data = make_av_trajectories(args.n_tracks, seed=args.seed)
+data = smooth_data_batched(data, args.smoothing_sigma)
+if args.decimate_factor > 1:
+    data = decimate_data_batched(data, args.decimate_factor)
+X = to_time_series_dataset(list(data.values()))
+
+configs = [("none", dtw_metric_params())]
+configs += [
+    (f"sakoe_chiba_{r}", dtw_metric_params("sakoe_chiba", sakoe_chiba_radius=r))
+    for r in args.radii
+]
+configs += [
+    (
+        f"itakura_{args.itakura_max_slope}",
+        dtw_metric_params("itakura", itakura_max_slope=args.itakura_max_slope),
+    )
+]
+
+# compile the numba DTW kernels before timing
+for _, metric_params in configs[:2]:
+    TimeSeriesKMeans(n_clusters=2, metric="dtw", metric_params=metric_params).fit(
+        X[:10]
+    )
+
+print("constraint\tlb_pruning\ttime_s\tspeedup\tn_iter\tn_dtw\tari\tselection_overlap")
+reference = None
+for name, metric_params in configs:
+    for lb_pruning in (False, True):
+        try:
+            result = run(X, metric_params, lb_pruning, args)
+        except RuntimeWarning as e:
+            # unfeasible Itakura constraint for the trajectory lengths
+            print(f"{name}\t{lb_pruning}\tfailed: {e}")
+            continue
+
+        if reference is None:
+            reference = result
+
+        ari = adjusted_rand_score(reference["labels"], result["labels"])
+        overlap = len(reference["selected"] & result["selected"]) / len(
+            reference["selected"]
+        )
+        print(
+            f"{name}\t{lb_pruning}\t{result['time']:.2f}\t"
+            f"{reference['time'] / result['time']:.1f}x\t{result['n_iter']}\t"
+            f"{result['n_dtw']}\t"
+            f"{ari:.3f}\t{overlap:.3f}"
+        )
@@ -0,0 +1,78 @@
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from sklearn.metrics import adjusted_rand_score
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils import smooth_data_batched, decimate_data_batched
+from clustering import fit_clusters, select_closest
+from clustering_utils import RaggedTrajectories, resample_trajectories
+from synthetic import make_av_trajectories
+
+# Runtime of the fixed-length euclidean engines of `clustering.py` compared to the
+# DTW k-means engine, and agreement of their results with it: adjusted Rand index of
+# the labels and overlap of the selected tracks.
+
+
+def run(engine: str, X: RaggedTrajectories, n_clusters: int, args) -> dict:
+    """Cluster with `engine` and select the tracks closest to each center."""
+
+    start = time.perf_counter()
+    X_resampled = None
+    if engine.startswith("euclidean"):
+        X_resampled = resample_trajectories(X, args.resample_length)
+
+    centers, labels, distances = fit_clusters(
+        engine, X, n_clusters, args.seed, dict(), X_resampled=X_resampled
+    )
+    indices = select_closest(
+        X, centers, distances, args.n_samples // n_clusters, dict()
+    )
+
+    return {
+        "time": time.perf_counter() - start,
+        "labels": labels,
+        "selected": set(indices.ravel().tolist()),
+    }
+
+
+parser = ArgumentParser()
+parser.add_argument("--n-tracks", type=int, default=300)
+parser.add_argument("--n-clusters", type=int, nargs="+", default=[3, 5, 10])
+parser.add_argument("--n-samples", type=int, default=60)
+parser.add_argument("--resample-length", type=int, default=64)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--smoothing-sigma", type=int, default=5)
+parser.add_argument("--decimate-factor", type=int, default=5)
+args = parser.parse_args()
+
+data = make_av_trajectories(args.n_tracks, seed=args.seed)
+data = decimate_data_batched(
+    smooth_data_batched(data, args.smoothing_sigma), args.decimate_factor
+)
+X = RaggedTrajectories(list(data.values()))
+
+# compile the numba DTW kernels before timing
+fit_clusters(
+    "dtw-kmeans", RaggedTrajectories([X[i] for i in range(10)]), 2, args.seed, dict()
+)
+
+print("n_clusters\tengine\ttime_s\tspeedup\tari\tselection_overlap")
+for n_clusters in args.n_clusters:
+    reference = run("dtw-kmeans", X, n_clusters, args)
+    for engine in ("dtw-kmeans", "euclidean-kmeans", "euclidean-minibatch"):
+        if engine == "dtw-kmeans":
+            result = reference
+        else:
+            result = run(engine, X, n_clusters, args)
+
+        ari = adjusted_rand_score(reference["labels"], result["labels"])
+        overlap = len(reference["selected"] & result["selected"]) / len(
+            reference["selected"]
+        )
+        print(
+            f"{n_clusters}\t{engine}\t{result['time']:.2f}\t"
+            f"{reference['time'] / result['time']:.1f}x\t{ari:.3f}\t{overlap:.3f}"
+        )
@@ -0,0 +1,78 @@
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils import (
+    smooth_data,
+    decimate_data,
+    smooth_data_batched,
+    decimate_data_batched,
+)
+from synthetic import make_av_trajectories
+
+# Compare the per-track and batched smoothing/decimation: check that both give the
+# same trajectories and report their run times across dataset sizes.
+
+
+def check_parity(reference: dict, batched: dict, atol: float) -> float:
+    """Check that two dicts of trajectories match and return the max abs. difference."""
+
+    assert list(reference.keys()) == list(batched.keys()), "tids differ"
+
+    max_diff = 0.0
+    for k, v in reference.items():
+        assert v.shape == batched[k].shape, f"shape mismatch for {k}"
+        assert batched[k].dtype == np.float32, f"{k} is not float32"
+        max_diff = max(max_diff, float(np.max(np.abs(v - batched[k]))))
+    assert max_diff <= atol, f"max abs. difference {max_diff} > {atol}"
+
+    return max_diff
+
+
+def timeit(func, *args, repeat: int = 3) -> float:
+    """Return the best wall time of `repeat` calls."""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+parser = ArgumentParser()
+parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+parser.add_argument("--sigma", type=int, default=5)
+parser.add_argument("--factor", type=int, default=5)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--atol", type=float, default=1e-6)
+args = parser.parse_args()
+
+print("n_tracks\tstage\tper_track_s\tbatched_s\tspeedup\tmax_abs_diff")
+for n_tracks in args.sizes:
+    data = make_av_trajectories(n_tracks)
+
+    smooth = smooth_data(data, args.sigma)
+    smooth_batched = smooth_data_batched(data, args.sigma)
+    diff_smooth = check_parity(smooth, smooth_batched, args.atol)
+
+    decimated = decimate_data(smooth, args.factor)
+    decimated_batched = decimate_data_batched(smooth_batched, args.factor)
+    diff_decimate = check_parity(decimated, decimated_batched, args.atol)
+
+    for stage, func, func_batched, stage_data, diff in (
+        ("smooth", smooth_data, smooth_data_batched, data, diff_smooth),
+        ("decimate", decimate_data, decimate_data_batched, smooth, diff_decimate),
+    ):
+        param = args.sigma if stage == "smooth" else args.factor
+        t_ref = timeit(func, stage_data, param, repeat=args.repeat)
+        t_batched = timeit(func_batched, stage_data, param, repeat=args.repeat)
+        print(
+            f"{n_tracks}\t{stage}\t{t_ref:.3f}\t{t_batched:.3f}\t"
+            f"{t_ref / t_batched:.1f}x\t{diff:.2e}"
+        )
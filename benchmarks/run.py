@@ -0,0 +1,180 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import scipy
+import tslearn
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(REPO_DIR))
+from utils import (
+    load_av_time_data,
+    smooth_data,
+    decimate_data,
+    smooth_data_batched,
+    decimate_data_batched,
+)
+from tracks_table import load_tracks
+from profiling import StageProfiler
+import clustering
+from synthetic import make_dataset
+
+# Benchmark of the whole preselection pipeline on a synthetic dataset.
+# Runs offline with fixed seeds and reports the best of `--repeat` runs of each stage
+# together with the git commit and the library versions, so that the JSON results of
+# different commits can be compared.
+
+
+def timeit(func, repeat: int) -> dict:
+    """Return the wall times of `repeat` calls of `func` and their minimum."""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return {"best_s": min(times), "times_s": times}
+
+
+def git_info() -> dict:
+    """Return the current commit and whether the working tree has changes."""
+
+    def git(*command):
+        return subprocess.run(
+            ["git", "-C", str(REPO_DIR), *command],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain"))}
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--root",
+    type=Path,
+    help="Directory of the synthetic dataset, generated if missing "
+    "(defaults to a directory per size in the temporary directory).",
+)
+parser.add_argument("--n-tracks", type=int, default=1000)
+parser.add_argument("--n-styles", type=int, default=400)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--n-samples-per-genre", type=int, default=50)
+parser.add_argument(
+    "--engine", type=str, default="dtw-kmeans", choices=clustering.engines
+)
+parser.add_argument("--jobs", "-j", type=int, default=1)
+parser.add_argument("--output", "-o", type=Path, help="Output JSON file.")
+args = parser.parse_args()
+
+root = args.root or Path(
+    tempfile.gettempdir(),
+    f"manymusic-synthetic-{args.n_tracks}-{args.n_styles}-{args.seed}",
+)
+if not (root / "data" / "clean_tids.json").exists():
+    make_dataset(root, args.n_tracks, n_styles=args.n_styles, seed=args.seed)
+
+# the scripts use paths relative to the repository root
+os.chdir(root)
+
+results = dict()
+
+tracks = load_tracks()
+with open("data/clean_tids.json") as f:
+    tids_clean = set(json.load(f))
+
+results["load_av_time_data"] = timeit(
+    lambda: load_av_time_data(tids_clean, tracks), args.repeat
+)
+data_av, _ = load_av_time_data(tids_clean, tracks)
+data_smoothed = smooth_data_batched(data_av, 5)
+
+for name, func, data in (
+    ("smooth_data", lambda d: smooth_data(d, 5), data_av),
+    ("smooth_data_batched", lambda d: smooth_data_batched(d, 5), data_av),
+    ("decimate_data", lambda d: decimate_data(d, 5), data_smoothed),
+    ("decimate_data_batched", lambda d: decimate_data_batched(d, 5), data_smoothed),
+):
+    results[name] = timeit(lambda: func(data), args.repeat)
+
+# the clustering is slow, run it once and report its stages
+clustering_args = clustering.parse_args(
+    [
+        "--n-samples-per-genre",
+        str(args.n_samples_per_genre),
+        "--engine",
+        args.engine,
+        "--jobs",
+        str(args.jobs),
+        "--seed",
+        str(args.seed),
+        "--no-cache",
+        "--force",
+    ]
+)
+profiler = StageProfiler()
+start = time.perf_counter()
+inputs = clustering.load_inputs(clustering_args, Path("data/"), profiler)
+data_av_decimated = clustering.preprocess_inputs(clustering_args, inputs, profiler)
+clustering.run_clustering(
+    clustering_args, inputs, data_av_decimated, Path("data/"), profiler
+)
+results["clustering"] = {
+    "best_s": time.perf_counter() - start,
+    "stages": profiler.summary(),
+}
+
+candidates_file = (
+    clustering.get_results_dir(clustering_args, Path("data/")) / "candidates.json"
+)
+results["postprocess"] = timeit(
+    lambda: subprocess.run(
+        [
+            sys.executable,
+            str(REPO_DIR / "postprocess.py"),
+            str(candidates_file),
+            "--output",
+            "data/candidates.tsv",
+            "--chunk-size",
+            "200",
+        ],
+        check=True,
+        capture_output=True,
+    ),
+    args.repeat,
+)
+
+report = {
+    **git_info(),
+    "date": datetime.now().isoformat(),
+    "params": {k: str(v) for k, v in vars(args).items()},
+    "n_tracks_clean": len(tids_clean),
+    "environment": {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "tslearn": tslearn.__version__,
+    },
+    "results": results,
+}
+
+print("stage\tbest_s")
+for name, result in results.items():
+    print(f"{name}\t{result['best_s']:.3f}")
+
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
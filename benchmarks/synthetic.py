@@ -0,0 +1,154 @@
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Generators of synthetic data mimicking the shapes of the MTG Jamendo predictions,
+# so that the benchmarks can run without the real `data/` tree.
+
+# parent genres of the Discogs taxonomy
+GENRES = (
+    "Blues",
+    "Brass & Military",
+    "Children's",
+    "Classical",
+    "Electronic",
+    "Folk, World, & Country",
+    "Funk / Soul",
+    "Hip Hop",
+    "Jazz",
+    "Latin",
+    "Non-Music",
+    "Pop",
+    "Reggae",
+    "Rock",
+    "Stage & Screen",
+)
+STYLE_PREFIX = "genre_discogs400-discogs-effnet-1"
+AV_MODEL = "emomusic-msd-musicnn-2"
+MOOD_TAGS = ("happy", "sad", "energetic", "relaxing", "dark", "epic")
+
+
+def random_walks(rng: np.random.Generator, lengths: np.ndarray) -> list:
+    """Generate 2D random walks in [-1, 1] of the given lengths."""
+
+    walks = []
+    for length in lengths:
+        # smooth random walks around a random mean
+        steps = rng.normal(0, 0.05, size=(length, 2))
+        trajectory = rng.uniform(-0.5, 0.5, size=2) + np.cumsum(steps, axis=0)
+        walks.append(np.clip(trajectory, -1, 1).astype(np.float32))
+
+    return walks
+
+
+def make_av_trajectories(
+    n_tracks: int,
+    min_length: int = 60,
+    max_length: int = 400,
+    seed: int = 0,
+) -> dict:
+    """Generate ragged arousal/valence trajectories normalized to [-1, 1].
+
+    Lengths are drawn uniformly in frames (~1 s per frame for emomusic-msd-musicnn-2).
+    """
+
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(min_length, max_length, size=n_tracks)
+
+    return dict(enumerate(random_walks(rng, lengths)))
+
+
+def make_dataset(
+    root: Path,
+    n_tracks: int,
+    n_styles: int = 400,
+    min_duration: int = 60,
+    max_duration: int = 400,
+    seed: int = 0,
+) -> None:
+    """Write a synthetic copy of the files read by the preselection pipeline.
+
+    Creates, under `root`, the predictions TSV and pickles, `clean_tids.json`, the
+    time-wise AV predictions (one `.npy` per track, ~1 frame per second) in `data/`,
+    and the autotagging TSV in `mtg-jamendo-dataset/data/`.
+    """
+
+    root = Path(root)
+    rng = np.random.default_rng(seed)
+
+    tids = np.sort(rng.choice(1_500_000, n_tracks, replace=False))
+    paths = [f"{tid % 100:02d}/{tid}" for tid in tids]
+
+    # sparse style activations, a few styles per track
+    styles = [
+        f"{STYLE_PREFIX}---{GENRES[i % len(GENRES)]}---Style {i}"
+        for i in range(n_styles)
+    ]
+    activations = rng.gamma(0.05, size=(n_tracks, n_styles))
+    activations /= activations.sum(axis=1, keepdims=True)
+
+    data_dir = root / "data"
+    data_dir.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(activations, index=paths, columns=styles).to_csv(
+        data_dir / "mtg-jamendo-predictions.tsv", sep="\t"
+    )
+    pd.DataFrame(
+        {
+            f"{AV_MODEL}---valence": rng.uniform(2, 8, n_tracks),
+            f"{AV_MODEL}---arousal": rng.uniform(2, 8, n_tracks),
+        },
+        index=paths,
+    ).to_pickle(data_dir / "mtg-jamendo-predictions-av.pk")
+    pd.DataFrame(
+        {"bpm": rng.uniform(60, 180, n_tracks)}, index=paths
+    ).to_pickle(data_dir / "mtg-jamendo-predictions-algos.pk")
+
+    # albums of 1 to ~12 tracks, artists of 1 to ~3 albums
+    album_sizes = rng.geometric(0.3, size=n_tracks)
+    album_ids = np.repeat(np.arange(n_tracks), album_sizes)[:n_tracks]
+    artist_ids = album_ids // rng.integers(1, 4)
+    durations = rng.uniform(min_duration, max_duration, size=n_tracks).round(1)
+
+    autotagging_file = root / "mtg-jamendo-dataset/data/autotagging.tsv"
+    autotagging_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(autotagging_file, "w") as f:
+        f.write("TRACK_ID\tARTIST_ID\tALBUM_ID\tPATH\tDURATION\tTAGS\n")
+        for i, tid in enumerate(tids):
+            genre = GENRES[activations[i].argmax() % len(GENRES)]
+            mood = MOOD_TAGS[rng.integers(len(MOOD_TAGS))]
+            f.write(
+                f"track_{tid:07d}\tartist_{artist_ids[i]:06d}\t"
+                f"album_{album_ids[i]:06d}\t{paths[i]}.mp3\t{durations[i]}\t"
+                f"genre---{genre.lower()}\tmood/theme---{mood}\n"
+            )
+
+    # AV predictions in the original [1, 9] range
+    av_dir = data_dir / "predictions" / AV_MODEL
+    lengths = durations.astype(int)
+    for path, walk in zip(paths, random_walks(rng, lengths)):
+        av_file = (av_dir / path).with_suffix(".npy")
+        av_file.parent.mkdir(parents=True, exist_ok=True)
+        np.save(av_file, 5 + 4 * walk)
+
+    # a few tracks are filtered out by the curation app
+    tids_clean = tids[rng.uniform(size=n_tracks) > 0.05]
+    with open(data_dir / "clean_tids.json", "w") as f:
+        json.dump(tids_clean.tolist(), f)
+
+    print(f"Wrote a synthetic dataset of {n_tracks} tracks to {root}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Generate a synthetic copy of the preselection pipeline inputs."
+    )
+    parser.add_argument("root", type=Path, help="Output directory.")
+    parser.add_argument("--n-tracks", type=int, default=1000)
+    parser.add_argument("--n-styles", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    make_dataset(args.root, args.n_tracks, n_styles=args.n_styles, seed=args.seed)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+
+from av_store import cache_key
+from io_utils import save_json_atomic
+from utils import normalize_string
+
+# Per-genre checkpoints and result files of `clustering.py`.
+# A checkpoint holds the selection of a genre and a hash of everything it depends on
+# (the parameters of the run, the genre pool and its trajectories). It is written
+# atomically once the genre is done, so an interrupted run resumes from the genres
+# left and `candidates.json` can always be rebuilt from the checkpoints.
+
+CHECKPOINTS_DIR = "checkpoints"
+
+# arguments of `clustering.py` that do not change the results
+RUN_ARGS = (
+    "force",
+    "incremental",
+    "jobs",
+    "no_plots",
+    "cache_dir",
+    "no_cache",
+    "cache_max_size",
+    "cache_max_age",
+    "distance_cache_dir",
+    "distance_cache_max_size",
+    "distance_cache_max_age",
+    "lb_pruning",
+)
+
+
+def params_hash(args) -> str:
+    """Hash the arguments of a clustering run that change its results."""
+
+    return cache_key(
+        {k: str(v) for k, v in sorted(vars(args).items()) if k not in RUN_ARGS}
+    )
+
+
+def pool_hash(
+    params_hash: str, tids: list, tids_av: list, fingerprints: np.ndarray
+) -> str:
+    """Hash the run parameters, the pool of a genre and its trajectories."""
+
+    h = hashlib.blake2b(params_hash.encode(), digest_size=16)
+    h.update(np.asarray(tids, dtype=np.int64).tobytes())
+    h.update(np.asarray(tids_av, dtype=np.int64).tobytes())
+    h.update(np.asarray(fingerprints, dtype=np.uint64).tobytes())
+    return h.hexdigest()
+
+
+def centers_hash(centers: np.ndarray) -> str:
+    """Hash the cluster centers, to match a selection table with its centers file."""
+
+    centers = np.ascontiguousarray(centers)
+    h = hashlib.blake2b(str(centers.shape).encode(), digest_size=16)
+    h.update(centers.astype(np.float64).tobytes())
+    return h.hexdigest()
+
+
+def selection_file(results_dir: Path, genre: str) -> Path:
+    return results_dir / f"{normalize_string(genre)}_selection.parquet"
+
+
+def centers_file(results_dir: Path, genre: str) -> Path:
+    return results_dir / f"kmeans_centers_{normalize_string(genre)}.npy"
+
+
+def scatter_file(results_dir: Path, genre: str) -> Path:
+    return results_dir / f"{normalize_string(genre)}_av_scatter.png"
+
+
+def checkpoint_file(results_dir: Path, genre: str) -> Path:
+    return results_dir / CHECKPOINTS_DIR / f"{normalize_string(genre)}.json"
+
+
+def save_checkpoint(
+    results_dir: Path, genre: str, genre_hash: str, selection: dict
+) -> None:
+    """Mark a genre as done with its selection."""
+
+    save_json_atomic(
+        checkpoint_file(results_dir, genre),
+        {"genre": genre, "hash": genre_hash, "selection": selection},
+    )
+
+
+def load_checkpoint(results_dir: Path, genre: str) -> dict:
+    """Return the checkpoint of a genre, or `None` if it was not processed."""
+
+    path = checkpoint_file(results_dir, genre)
+    if not path.exists():
+        return None
+
+    with open(path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,115 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Per-chunk manifest of the candidates TSV written by `postprocess.py`.
+# Each chunk is saved in its own small TSV next to an index of the chunk sizes, so the
+# annotator loads the tids of a chunk without reading and filtering the whole list of
+# candidates.
+
+INDEX_FILE = "index.json"
+
+
+def chunks_dir(candidates_file: Path) -> Path:
+    """Return the manifest directory of a candidates TSV."""
+
+    candidates_file = Path(candidates_file)
+    return candidates_file.with_name(f"{candidates_file.stem}_chunks")
+
+
+def chunk_file(candidates_file: Path, chunk_id: int) -> Path:
+    return chunks_dir(candidates_file) / f"chunk_{chunk_id}.tsv"
+
+
+def balanced_chunks(
+    efforts: np.ndarray, n_chunks: int, strata: np.ndarray = None
+) -> np.ndarray:
+    """Assign items to `n_chunks` chunks of balanced total effort.
+
+    Greedy longest-processing-time bin packing: the items are taken by decreasing
+    effort and assigned to the chunk with the lowest total. With `strata`, each chunk
+    also gets the same number of items of every stratum (up to one), the largest
+    strata being assigned first. Ties keep the order of the items.
+    """
+
+    efforts = np.asarray(efforts, dtype=np.float64)
+    stratified = strata is not None
+    strata = np.asarray(strata) if stratified else np.zeros(len(efforts), dtype=int)
+
+    loads = np.zeros(n_chunks)
+    chunk_ids = np.empty(len(efforts), dtype=int)
+    all_chunks = np.arange(n_chunks)
+
+    labels, counts = np.unique(strata, return_counts=True)
+    for label in labels[np.argsort(-counts, kind="stable")]:
+        items = np.flatnonzero(strata == label)
+        items = items[np.argsort(-efforts[items], kind="stable")]
+
+        n_items = np.zeros(n_chunks, dtype=int)
+        for item in items:
+            # least loaded of the chunks with the fewest items of this stratum
+            candidates = (
+                np.flatnonzero(n_items == n_items.min()) if stratified else all_chunks
+            )
+            chunk_id = candidates[np.argmin(loads[candidates])]
+
+            chunk_ids[item] = chunk_id
+            loads[chunk_id] += efforts[item]
+            n_items[chunk_id] += 1
+
+    return chunk_ids
+
+
+def write_chunks(candidates: pd.DataFrame, candidates_file: Path) -> None:
+    """Write the manifest of the candidates split by `chunk_id`."""
+
+    manifest_dir = chunks_dir(candidates_file)
+    manifest_dir.mkdir(parents=True, exist_ok=True)
+
+    # chunks of a previous split
+    for path in manifest_dir.glob("chunk_*.tsv"):
+        path.unlink()
+
+    sizes = dict()
+    for chunk_id, chunk in candidates.groupby("chunk_id"):
+        chunk.to_csv(chunk_file(candidates_file, chunk_id), sep="\t", index=False)
+        sizes[str(chunk_id)] = len(chunk)
+
+    # the index is written last, it marks the manifest as complete
+    with open(manifest_dir / INDEX_FILE, "w") as f:
+        json.dump({"candidates": Path(candidates_file).name, "chunks": sizes}, f)
+
+
+def has_chunks(candidates_file: Path) -> bool:
+    """Check whether an up-to-date manifest exists for a candidates TSV."""
+
+    index_file = chunks_dir(candidates_file) / INDEX_FILE
+    if not index_file.exists():
+        return False
+
+    return index_file.stat().st_mtime >= Path(candidates_file).stat().st_mtime
+
+
+def load_chunk_index(candidates_file: Path) -> dict:
+    """Return the number of tracks of each chunk, by chunk id."""
+
+    if has_chunks(candidates_file):
+        with open(chunks_dir(candidates_file) / INDEX_FILE, "r") as f:
+            return json.load(f)["chunks"]
+
+    # older candidates without a manifest
+    chunk_ids = pd.read_csv(candidates_file, sep="\t", usecols=["chunk_id"])["chunk_id"]
+    return {str(k): int(v) for k, v in chunk_ids.value_counts(sort=False).items()}
+
+
+def load_chunk_tids(candidates_file: Path, chunk_id: str) -> list:
+    """Return the tids of a chunk, in the order of the candidates TSV."""
+
+    if has_chunks(candidates_file):
+        chunk = pd.read_csv(chunk_file(candidates_file, chunk_id), sep="\t")
+        return chunk["tid"].tolist()
+
+    candidates = pd.read_csv(candidates_file, sep="\t", usecols=["tid", "chunk_id"])
+    return candidates.loc[candidates["chunk_id"] == int(chunk_id), "tid"].tolist()
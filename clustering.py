@@ -1,134 +1,388 @@
-import cmath
 import json
-import sys
+import multiprocessing
+import zlib
 from argparse import ArgumentParser
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+from tslearn.metrics import cdist_dtw
 from tslearn.utils import to_time_series_dataset
 from tslearn.clustering import TimeSeriesKMeans
+from scipy.spatial.distance import cdist
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.metrics import silhouette_score
 
-from utils import load_av_time_data, smooth_data, decimate_data, normalize_string
-
-sys.path.append("mtg-jamendo-dataset/scripts/")
-import commons
+from utils import (
+    load_av_time_data,
+    print_av_load_report,
+    preprocess_av_data,
+)
+from av_store import PREPROCESSED_CACHE_DIR, evict_cache
+from feature_store import GenreIndex, add_av_columns, load_data, load_genres
+from clustering_utils import (
+    DTW_DISTANCE_CACHE_DIR,
+    GLOBAL_CONSTRAINTS,
+    DTWDistanceCache,
+    evict_distance_cache,
+    RaggedTrajectories,
+    album_cap_select,
+    auto_max_length,
+    dtw_metric_params,
+    kmedoids,
+    limit_length,
+    max_length_arg,
+    nearest_series,
+    resample_trajectories,
+    trajectory_fingerprints,
+)
+from tracks_table import load_tracks
+from profiling import StageProfiler, stage
+from checkpoints import (
+    centers_file,
+    centers_hash,
+    load_checkpoint,
+    params_hash,
+    pool_hash,
+    save_checkpoint,
+    scatter_file,
+    selection_file,
+)
+from io_utils import save_json_atomic, save_npy_atomic, write_atomic
 
 
 n_cluster_choices = [3, 5, 10]
 
+engines = ("dtw-kmeans", "dtw-kmedoids", "euclidean-kmeans", "euclidean-minibatch")
 
-def load_data():
-    """Load and prepare ground truth in the streamlit cache."""
-
-    data_models = pd.read_csv(
-        data_dir / "mtg-jamendo-predictions.tsv", sep="\t", index_col=0
-    )
-    data_av = pd.read_pickle(data_dir / "mtg-jamendo-predictions-av.pk")
-    data_algos = pd.read_pickle(data_dir / "mtg-jamendo-predictions-algos.pk")
-
-    data = pd.concat([data_models, data_av, data_algos], axis=1)
-    data.index = pd.Index(map(lambda x: int(x.split("/")[1]), data.index))
 
-    mtg_jamendo_file = "mtg-jamendo-dataset/data/autotagging.tsv"
-    tracks, _, _ = commons.read_file(mtg_jamendo_file)
-    return data, tracks
+def genre_seed(genre: str, seed: int) -> int:
+    """Derive a per-genre random seed that does not depend on the processing order."""
 
+    return (seed + zlib.crc32(genre.encode())) % 2**32
 
-def get_quadrant_ids(data, quadrant, field):
-    """Get the ids of the samples in the specified quadrant."""
 
-    quad_rad_ss = {"A+V+": 0, "A-V+": -np.pi / 2, "A+V-": np.pi / 2, "A-V-": -np.pi}
-    quad_rad_es = {"A+V+": np.pi / 2, "A-V+": 0, "A+V-": np.pi, "A-V-": -np.pi / 2}
+def add_clustering_args(parser: ArgumentParser) -> None:
+    """Add the options shared by `clustering.py` and `sweep.py`."""
 
-    quad_rad_s = quad_rad_ss[quadrant]
-    quad_rad_e = quad_rad_es[quadrant]
+    parser.add_argument("--av-model", type=str, default="emomusic")
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Instead of skipping the processed genres, assign their new or changed "
+        "tracks to the saved centers (without refitting) and update the selection.",
+    )
+    parser.add_argument(
+        "--no-plots",
+        action="store_true",
+        help="Do not plot the AV scatters (see `plot_clusters.py` to plot them later).",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=PREPROCESSED_CACHE_DIR,
+        help="Directory of the preprocessed AV trajectories cache.",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Do not read or write the cache."
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=float,
+        default=10.0,
+        help="Maximum size of the cache in GB. The least recently used entries are evicted.",
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=30.0,
+        help="Evict cache entries not used in this number of days.",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of genres processed in parallel.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Base random seed, combined with the genre name for each genre.",
+    )
+    parser.add_argument(
+        "--global-constraint",
+        type=str,
+        default="none",
+        choices=GLOBAL_CONSTRAINTS,
+        help="DTW global constraint. Itakura fails for trajectories whose lengths "
+        "differ by more than a factor `--itakura-max-slope`.",
+    )
+    parser.add_argument(
+        "--sakoe-chiba-radius",
+        type=int,
+        default=5,
+        help="Radius of the Sakoe-Chiba band, in decimated frames.",
+    )
+    parser.add_argument("--itakura-max-slope", type=float, default=2.0)
+    parser.add_argument(
+        "--lb-pruning",
+        action="store_true",
+        help="Use LB_Keogh lower bounds to prune the DTW computations of the "
+        "nearest-center assignment and of the candidate selection.",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="dtw-kmeans",
+        choices=engines,
+        help="`dtw-kmeans`: tslearn k-means with DTW barycenters. `dtw-kmedoids`: "
+        "k-medoids on the pairwise DTW matrix, which is cached and shared by all "
+        "the cluster counts and genres. `euclidean-kmeans` and `euclidean-minibatch`: "
+        "(mini-batch) k-means on the trajectories resampled to `--resample-length` "
+        "frames, much faster, for exploratory runs.",
+    )
+    parser.add_argument(
+        "--max-length",
+        type=max_length_arg,
+        help="Limit the decimated trajectories to this number of frames, so that a "
+        "few very long tracks do not inflate the padded DTW k-means batches. `auto` "
+        "uses the 99th percentile of the trajectory lengths.",
+    )
+    parser.add_argument(
+        "--max-length-mode",
+        type=str,
+        default="cap",
+        choices=["cap", "resample"],
+        help="`cap`: keep the first `--max-length` frames. `resample`: resample the "
+        "longer trajectories to `--max-length` frames.",
+    )
+    parser.add_argument(
+        "--resample-length",
+        type=int,
+        default=64,
+        help="Number of frames of the resampled trajectories of the euclidean engines.",
+    )
+    parser.add_argument(
+        "--distance-cache-dir",
+        type=Path,
+        default=DTW_DISTANCE_CACHE_DIR,
+        help="Directory of the pairwise DTW distances cache used by `dtw-kmedoids`.",
+    )
+    parser.add_argument(
+        "--distance-cache-max-size",
+        type=float,
+        default=10.0,
+        help="Maximum size of the DTW distances cache in GB. The least recently used "
+        "blocks are evicted.",
+    )
+    parser.add_argument(
+        "--distance-cache-max-age",
+        type=float,
+        default=30.0,
+        help="Evict DTW distance blocks not used in this number of days.",
+    )
 
-    return data[data[field].apply(lambda x: x[1] > quad_rad_s and x[1] <= quad_rad_e)]
 
+def parse_args(argv: list = None):
+    parser = ArgumentParser()
+    parser.add_argument("--genre-threshold", type=float, default=0.1)
+    parser.add_argument("--n-samples-per-genre", type=int, default=200)
+    parser.add_argument("--smoothing-sigma", type=int, default=5)
+    parser.add_argument("--decimate-factor", type=int, default=5)
+    parser.add_argument(
+        "--norm", type=str, default="none", choices=["none", "minmax", "zscore"]
+    )
+    add_clustering_args(parser)
+    return parser.parse_args(argv)
+
+
+def fit_clusters(
+    engine: str,
+    X: RaggedTrajectories,
+    n_clusters: int,
+    random_state: int,
+    metric_params: dict,
+    lb_pruning: bool = False,
+    pairwise_distances: np.ndarray = None,
+    X_resampled: np.ndarray = None,
+    X_padded: np.ndarray = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Cluster the AV trajectories `X`.
+
+    `dtw-kmedoids` needs the `pairwise_distances` and the euclidean engines the
+    trajectories resampled to a fixed length (`X_resampled`). `dtw-kmeans` pads `X`
+    unless its padded version (`X_padded`) is given.
+    Returns the cluster centers, the labels and the distances of every sample to
+    every center (`None` when they were not computed because of `lb_pruning`).
+    """
+
+    if engine == "dtw-kmedoids":
+        medoids, labels = kmedoids(pairwise_distances, n_clusters, random_state)
+        centers = to_time_series_dataset([X[i] for i in medoids])
+        return centers, labels, pairwise_distances[:, medoids]
+
+    if engine in ("euclidean-kmeans", "euclidean-minibatch"):
+        model = KMeans if engine == "euclidean-kmeans" else MiniBatchKMeans
+        kmeans = model(n_clusters=n_clusters, n_init=10, random_state=random_state)
+        features = X_resampled.reshape(len(X_resampled), -1)
+        distances = kmeans.fit_transform(features)
+        centers = kmeans.cluster_centers_.reshape(n_clusters, *X_resampled.shape[1:])
+        return centers, kmeans.labels_, distances
+
+    kmeans = TimeSeriesKMeans(
+        n_clusters=n_clusters,
+        metric="dtw",
+        metric_params=metric_params,
+        max_iter_barycenter=10,
+        random_state=random_state,
+    )
+    if X_padded is None:
+        X_padded = X.padded()
+
+    if lb_pruning:
+        # the fit already assigns the labels, the distances are left to the
+        # pruned selection of the closest samples
+        kmeans.fit(X_padded)
+        return kmeans.cluster_centers_, kmeans.labels_, None
+
+    distances = kmeans.fit_transform(X_padded)
+
+    # the labels are the closest centers, no need to compute the DTW again
+    return kmeans.cluster_centers_, np.argmin(distances, axis=1), distances
+
+
+def center_distances(
+    engine: str,
+    X: RaggedTrajectories,
+    centers: np.ndarray,
+    metric_params: dict,
+    resample_length: int,
+) -> np.ndarray:
+    """Return the distances of the trajectories `X` to saved centers, as in `engine`."""
+
+    if engine.startswith("euclidean"):
+        features = resample_trajectories(X, resample_length).reshape(len(X), -1)
+        return cdist(features, centers.reshape(len(centers), -1))
+
+    return cdist_dtw(X.padded(), centers, **metric_params)
+
+
+def incremental_distances(
+    selection: pd.DataFrame,
+    tids: list,
+    fingerprints: np.ndarray,
+    X: RaggedTrajectories,
+    centers: np.ndarray,
+    engine: str,
+    metric_params: dict,
+    resample_length: int,
+) -> np.ndarray:
+    """Return the distances of `X` to the saved `centers`.
+
+    The distances of the tracks in the saved `selection` table whose trajectory did
+    not change are reused, only the other ones are computed. The saved distances are
+    only reused if they were computed to the same `centers`.
+    """
+
+    distance_columns = [f"distance_c{i}" for i in range(len(centers))]
+    distances = np.full((len(tids), len(centers)), np.nan)
+
+    known = np.zeros(len(tids), dtype=bool)
+    same_centers = "centers_hash" in selection.columns and (
+        (selection["centers_hash"] == centers_hash(centers)).all()
+    )
+    if not same_centers:
+        print("The saved selection does not match the saved centers, ignoring it.")
+    elif set(distance_columns + ["fingerprint"]) <= set(selection.columns):
+        saved = selection.reindex(tids)
+        saved_distances = saved[distance_columns].to_numpy(dtype=float)
+        known = (saved["fingerprint"] == fingerprints).fillna(False).to_numpy(bool)
+        known &= ~np.isnan(saved_distances).any(axis=1)
+        distances[known] = saved_distances[known]
+
+    delta = np.flatnonzero(~known)
+    print(
+        f"Incremental update: {len(delta)}/{len(tids)} new or changed tracks "
+        "assigned to the saved centers."
+    )
+    if len(delta):
+        distances[delta] = center_distances(
+            engine,
+            RaggedTrajectories([X[i] for i in delta]),
+            centers,
+            metric_params,
+            resample_length,
+        )
 
-parser = ArgumentParser()
-parser.add_argument("--genre-threshold", type=float, default=0.1)
-parser.add_argument("--n-samples-per-genre", type=int, default=200)
-parser.add_argument("--smoothing-sigma", type=int, default=5)
-parser.add_argument("--decimate-factor", type=int, default=5)
-parser.add_argument("--av-model", type=str, default="emomusic")
-parser.add_argument(
-    "--norm", type=str, default="none", choices=["none", "minmax", "zscore"]
-)
-parser.add_argument("--force", action="store_true")
-args = parser.parse_args()
-
-genre_threshold = args.genre_threshold
-n_samples_per_genre = args.n_samples_per_genre
-smoothing_sigma = args.smoothing_sigma
-decimate_factor = args.decimate_factor
-av_model = args.av_model
-norm_type = args.norm
-force = args.force
-
-
-data_dir = Path("data/")
-av_predictions_dir = data_dir / "predictions" / "emomusic-msd-musicnn-2"
-results_dir = (
-    data_dir
-    / "clustering"
-    / f"clustering_genre_thres_{genre_threshold}_n_samples_{n_samples_per_genre}_smoothing_{smoothing_sigma}_decimate_{decimate_factor}_norm_{norm_type}"
-)
+    return distances
 
-results_dir.mkdir(parents=True, exist_ok=True)
 
-# Load ids
-with open(data_dir / "clean_tids.json", "r") as f:
-    tids_clean = set(json.load(f))
+def select_closest(
+    X: RaggedTrajectories,
+    centers: np.ndarray,
+    distances: np.ndarray,
+    n_samples_per_cluster: int,
+    metric_params: dict,
+) -> np.ndarray:
+    """Return the indices of the samples closest to each center, one column per center."""
 
+    if distances is None:
+        indices, n_dtw = [], 0
+        for center in centers:
+            center_indices, _, center_n_dtw = nearest_series(
+                X, center, n_samples_per_cluster, metric_params
+            )
+            indices.append(center_indices)
+            n_dtw += center_n_dtw
+        print(f"LB_Keogh pruning: {n_dtw}/{len(X) * len(centers)} DTW computed.")
+        return np.stack(indices, axis=1)
 
-# Load data
-data, tracks = load_data()
+    sorting = np.argsort(distances, axis=0, kind="stable")
+    return sorting[:n_samples_per_cluster, :]
 
-# Normalize AV
-data[f"{av_model}-msd-musicnn-2---valence-norm"] = (
-    data[f"{av_model}-msd-musicnn-2---valence"] - 5
-) / 4
-data[f"{av_model}-msd-musicnn-2---arousal-norm"] = (
-    data[f"{av_model}-msd-musicnn-2---arousal"] - 5
-) / 4
 
-# Load AV timewise data
-data_av_clean, tids_clean = load_av_time_data(tids_clean, tracks)
-print(f"Kept {len(data_av_clean)} samples")
+# Read-only data shared with the worker processes. It is filled before the pool is
+# created, so the forked workers inherit it without copying or pickling.
+shared = dict()
 
-data_av_smooth = smooth_data(data_av_clean, smoothing_sigma)
 
-data_av_decimated = decimate_data(data_av_smooth, decimate_factor)
+def process_genre(genre: str) -> tuple[dict, list]:
+    """Select the candidate tracks of a genre and save its checkpoint.
 
+    Returns a dict mapping the source (`av_cluster_<i>`) to the list of selected
+    tids, or `None` if the genre has an up-to-date checkpoint, and the profiled
+    stages.
+    """
 
-data_styles = data.filter(like="genre_discogs400-discogs-effnet-1")
-data_genres = data_styles.groupby(lambda x: x.split("---")[1], axis=1).max()
-data_genres = data_genres[data_genres.index.isin(tids_clean)].copy()
+    args = shared["args"]
+    data = shared["data"]
+    data_genres = shared["data_genres"]
+    data_av_decimated = shared["data_av_decimated"]
+    tracks = shared["tracks"]
+    results_dir = shared["results_dir"]
 
-genres = set(data_genres.columns)
-genres_blacklist = set(["Non-Music", "Stage & Screen", "Children's"])
-genres_good = genres - genres_blacklist
+    genre_threshold = args.genre_threshold
+    n_samples_per_genre = args.n_samples_per_genre
+    av_model = args.av_model
 
+    metric_params = dtw_metric_params(
+        args.global_constraint, args.sakoe_chiba_radius, args.itakura_max_slope
+    )
 
-data_selected = dict()
-for genre in list(genres_good):
-    genre_n = normalize_string(genre)
-    results_file = results_dir / f"kmeans_centers_{genre_n}.npy"
+    results_file = centers_file(results_dir, genre)
 
-    if results_file.exists() and not force:
-        print(f"Skipping genre {genre}, already processed.")
-        continue
+    profiler = StageProfiler()
 
-    data_selected[genre] = dict()
+    data_selected = dict()
 
     # Getting top activations for this genre
-    data_genre = data_genres[data_genres[genre] > genre_threshold].copy()
+    data_genre = data_genres.iloc[
+        shared["genre_index"].rows_above(genre, genre_threshold)
+    ].copy()
     data_genre["source"] = "Not assigned"
 
     tids = list(data_genre.index)
@@ -136,27 +390,14 @@ for genre in list(genres_good):
     if len(tids) < n_samples_per_genre:
         print(f"Genre {genre} has {len(tids)} samples, using all of them.")
     else:
-        for max_tracks_per_album in range(1, 10):
-            print(f"Keeping {max_tracks_per_album} samples per album for genre {genre}")
-
-            albums_dict = defaultdict(int)
-            tids_album_duplicated = set()
-
-            for tid in tids:
-                album = tracks[tid]["album_id"]
-                if albums_dict[album] >= max_tracks_per_album:
-                    tids_album_duplicated.add(tid)
-                albums_dict[album] += 1
-
-            tids_clean = set(tids) - tids_album_duplicated
-
-            if len(tids_clean) >= n_samples_per_genre:
-                print(
-                    f" {len(tids_clean)} samples, {max_tracks_per_album} tracks per album, enough."
-                )
-                break
-
-        data_genre = data_genre.loc[list(tids_clean)]
+        with profiler.stage("album_cap", genre=genre):
+            keep, max_tracks_per_album = album_cap_select(
+                tracks.album_ids(tids), n_samples_per_genre
+            )
+        data_genre = data_genre[keep]
+        print(
+            f" {len(data_genre)} samples, {max_tracks_per_album} tracks per album for genre {genre}."
+        )
 
     # Get AV data
     v_norm_field = f"{av_model}-msd-musicnn-2---valence-norm"
@@ -169,139 +410,364 @@ for genre in list(genres_good):
         data_genre.index, a_norm_field
     ]
 
+    tids_av_genre = [tid for tid in data_genre.index if tid in data_av_decimated]
+    data_av_genre = {k: data_av_decimated[k] for k in tids_av_genre}
+    fingerprints = trajectory_fingerprints(data_av_genre, tids_av_genre)
+
+    # skip the genre if neither the parameters nor its pool changed
+    genre_hash = pool_hash(
+        shared["params_hash"], data_genre.index, tids_av_genre, fingerprints
+    )
+    checkpoint = load_checkpoint(results_dir, genre)
+    if checkpoint is not None and checkpoint["hash"] == genre_hash and not args.force:
+        print(f"Skipping genre {genre}, already processed.")
+        return None, profiler.stages
+
+    incremental = (
+        args.incremental
+        and results_file.exists()
+        and selection_file(results_dir, genre).exists()
+    )
+
     if len(data_genre) < n_samples_per_genre:
         print(f"Genre {genre} has {len(data_genre)} samples, using all of them.")
-        data_selected[genre]["av_cluster_0"] = data_genre
+        data_selected["av_cluster_0"] = data_genre.index.tolist()
 
     else:
         # get prototypical av curves for this genre
-        data_av_genre = {
-            k: v for k, v in data_av_decimated.items() if k in data_genre.index
-        }
-        if norm_type == "zscore":
-            data_av_genre = {
-                k: (v - v.mean(axis=0)) / v.std(axis=0)
-                for k, v in data_av_genre.items()
-            }
-        tids_av_genre = list(data_av_genre.keys())
-
-        data_av_genre_ts = to_time_series_dataset(list(data_av_genre.values()))
-
-        best_sil_score = -np.inf
-        best_n_clusters = 0
-        best_kmeans = None
-        best_y_distances = None
-
-        for n_clusters in n_cluster_choices:
-            n_samples_per_cluster = n_samples_per_genre // n_clusters
-
-            print(
-                f"training k-means for {genre} with {len(data_av_genre_ts)} samples, and {n_clusters} clusters."
-            )
-            kmeans = TimeSeriesKMeans(
-                n_clusters=n_clusters, metric="dtw", max_iter_barycenter=10
-            )
-            y_distances = kmeans.fit_transform(data_av_genre_ts)
+        data_av_genre_ts = RaggedTrajectories(list(data_av_genre.values()))
+
+        if incremental:
+            with profiler.stage("incremental", genre=genre):
+                best_centers = np.load(results_file)
+                best_n_clusters = len(best_centers)
+                best_y_distances = incremental_distances(
+                    pd.read_parquet(selection_file(results_dir, genre)),
+                    tids_av_genre,
+                    fingerprints,
+                    data_av_genre_ts,
+                    best_centers,
+                    args.engine,
+                    metric_params,
+                    args.resample_length,
+                )
 
-            cluster_labels = kmeans.predict(data_av_genre_ts)
+        else:
+            pairwise_distances = None
+            if args.engine == "dtw-kmedoids":
+                with profiler.stage("distance_matrix", genre=genre):
+                    pairwise_distances = DTWDistanceCache(
+                        args.distance_cache_dir, shared["distance_cache_params"]
+                    ).distance_matrix(data_av_genre, tids_av_genre, metric_params)
+
+            data_av_genre_resampled = None
+            if args.engine.startswith("euclidean"):
+                data_av_genre_resampled = resample_trajectories(
+                    data_av_genre_ts, args.resample_length
+                )
 
-            # compute silhouette score on the time-averaged AV curves
-            # (we have seen that av. values preserve most of the info).
-            data_av_genre_ts_mean = np.array(
-                [v.mean(axis=0) for v in data_av_genre.values()]
-            )
-            print("av. data shape", data_av_genre_ts_mean.shape)
-            sil_score = silhouette_score(data_av_genre_ts_mean, cluster_labels)
+            # padded once for all the numbers of clusters
+            data_av_genre_padded = None
+            if args.engine == "dtw-kmeans":
+                data_av_genre_padded = data_av_genre_ts.padded()
 
-            print(
-                f"Silhouette score for {genre} with {n_clusters} clusters: {sil_score:.4f}"
-            )
+            best_sil_score = -np.inf
+            best_n_clusters = 0
+            best_centers = None
+            best_y_distances = None
 
-            if sil_score > best_sil_score:
-                best_n_clusters = n_clusters
-                best_sil_score = sil_score
-                best_kmeans = kmeans
-                best_y_distances = y_distances
-
-            else:
-                print("Silhouette score is not better than the best one, stopping.")
-                print("Best silhouette score:", best_sil_score)
-                print("Best number of clusters:", best_n_clusters)
-                break
-
-        np.save(
-            results_file,
-            best_kmeans.cluster_centers_,
-        )
+            for n_clusters in n_cluster_choices:
+                print(
+                    f"training {args.engine} for {genre} with {len(data_av_genre_ts)} samples, and {n_clusters} clusters."
+                )
+                with profiler.stage("fit", genre=genre, n_clusters=n_clusters):
+                    centers, cluster_labels, y_distances = fit_clusters(
+                        args.engine,
+                        data_av_genre_ts,
+                        n_clusters,
+                        genre_seed(genre, args.seed),
+                        metric_params,
+                        lb_pruning=args.lb_pruning,
+                        pairwise_distances=pairwise_distances,
+                        X_resampled=data_av_genre_resampled,
+                        X_padded=data_av_genre_padded,
+                    )
+
+                # compute silhouette score on the time-averaged AV curves
+                # (we have seen that av. values preserve most of the info).
+                with profiler.stage("silhouette", genre=genre, n_clusters=n_clusters):
+                    data_av_genre_ts_mean = np.array(
+                        [v.mean(axis=0) for v in data_av_genre.values()]
+                    )
+                    print("av. data shape", data_av_genre_ts_mean.shape)
+                    sil_score = silhouette_score(data_av_genre_ts_mean, cluster_labels)
 
-        n_samples_per_cluster = n_samples_per_genre // best_n_clusters
+                print(
+                    f"Silhouette score for {genre} with {n_clusters} clusters: {sil_score:.4f}"
+                )
 
-        sorting = np.argsort(best_y_distances, axis=0)
-        indices = sorting[:n_samples_per_cluster, :]
+                if sil_score > best_sil_score:
+                    best_n_clusters = n_clusters
+                    best_sil_score = sil_score
+                    best_centers = centers
+                    best_y_distances = y_distances
 
-        fig, ax = plt.subplots()
+                else:
+                    print("Silhouette score is not better than the best one, stopping.")
+                    print("Best silhouette score:", best_sil_score)
+                    print("Best number of clusters:", best_n_clusters)
+                    break
 
-        for i_cluster in range(best_n_clusters):
-            cluster_centroid = best_kmeans.cluster_centers_[i_cluster]
-            cluster_centroid_mean = np.mean(cluster_centroid, axis=0)
+        n_samples_per_cluster = n_samples_per_genre // best_n_clusters
+
+        with profiler.stage("select", genre=genre):
+            indices = select_closest(
+                data_av_genre_ts,
+                best_centers,
+                best_y_distances,
+                n_samples_per_cluster,
+                metric_params,
+            )
 
+        for i_cluster in range(best_n_clusters):
             clust_sample_tids = [tids_av_genre[i] for i in indices[:, i_cluster]]
-            data_selected[genre][f"av_cluster_{i_cluster}"] = data_genre.loc[
-                clust_sample_tids
-            ]
+            data_selected[f"av_cluster_{i_cluster}"] = clust_sample_tids
 
             data_genre.loc[clust_sample_tids, "source"] = f"av_cluster_{i_cluster}"
 
-            # sort byt soruce column
-            data_genre.sort_values("source", inplace=True)
-
-            ax.annotate(
-                f"C{i_cluster}",
-                (cluster_centroid_mean[0], cluster_centroid_mean[1]),
+        # selection table of the genre pool, used to plot the results
+        with profiler.stage("save_selection", genre=genre):
+            selection = data_genre[[v_norm_field, a_norm_field, "source"]].copy()
+            selection["fingerprint"] = pd.Series(
+                fingerprints, index=tids_av_genre, dtype="UInt64"
             )
+            if best_y_distances is not None:
+                for i_cluster in range(best_n_clusters):
+                    selection.loc[tids_av_genre, f"distance_c{i_cluster}"] = (
+                        best_y_distances[:, i_cluster]
+                    )
+            # the centers the distances were computed to, checked by `--incremental`
+            selection["centers_hash"] = centers_hash(best_centers)
+            write_atomic(selection_file(results_dir, genre), selection.to_parquet)
+
+        save_npy_atomic(results_file, best_centers)
+
+    quadrant_field = f"{av_model}-msd-musicnn-2---av-quadrant"
+    quadrant_counts = data.loc[data_genre.index, quadrant_field].value_counts(
+        sort=False
+    )
+
+    for q, count in quadrant_counts.items():
+        print(f"{genre} {q} has {count} ids.")
+
+    # the checkpoint is saved last, it marks the genre as processed
+    save_checkpoint(results_dir, genre, genre_hash, data_selected)
 
-        sns.scatterplot(
-            data=data_genre, x=v_norm_field, y=a_norm_field, hue="source"
-        ).set_title(genre)
+    return data_selected, profiler.stages
 
-        plt.axvline(0, color="k")
-        plt.axhline(0, color="k")
 
-        results_dir.mkdir(parents=True, exist_ok=True)
+def get_results_dir(args, data_dir: Path) -> Path:
+    """Return the results directory of a clustering configuration."""
 
-        plt.savefig(results_dir / f"{genre_n}_av_scatter.png")
-        plt.close(fig)
+    results_name = f"clustering_genre_thres_{args.genre_threshold}_n_samples_{args.n_samples_per_genre}_smoothing_{args.smoothing_sigma}_decimate_{args.decimate_factor}_norm_{args.norm}"
+    if args.global_constraint == "sakoe_chiba":
+        results_name += f"_sakoe_chiba_{args.sakoe_chiba_radius}"
+    elif args.global_constraint == "itakura":
+        results_name += f"_itakura_{args.itakura_max_slope}"
+    if args.max_length is not None:
+        results_name += f"_max_length_{args.max_length}_{args.max_length_mode}"
+    if args.engine != "dtw-kmeans":
+        results_name += f"_{args.engine}"
+    if args.engine.startswith("euclidean"):
+        results_name += f"_length_{args.resample_length}"
 
-    p_norm_field = "emomusic-msd-musicnn-2---av-polar-norm"
-    data_genre[p_norm_field] = [
-        cmath.polar(
-            complex(data_genre[v_norm_field][idx], data_genre[a_norm_field][idx])
+    return data_dir / "clustering" / results_name
+
+
+def load_inputs(args, data_dir: Path, profiler: StageProfiler = None) -> dict:
+    """Load the data shared by all the clustering configurations.
+
+    Returns the predictions table, the tracks table, the AV trajectories of the
+    clean tids with their version, and the genre activations with their per-genre
+    index.
+    """
+
+    av_model = args.av_model
+
+    with stage(profiler, "load_data"):
+        # Load ids
+        with open(data_dir / "clean_tids.json", "r") as f:
+            tids_clean = set(json.load(f))
+
+        # Load data, only the AV columns are needed
+        data = load_data(
+            data_dir,
+            like=[f"{av_model}-msd-musicnn-2---"],
         )
-        for idx in data_genre.index
-    ]
+        tracks = load_tracks()
+
+        # Normalize AV and assign the quadrants
+        data = add_av_columns(data, av_model)
+
+    # Load AV timewise data
+    with stage(profiler, "load_av"):
+        data_av_clean, av_report = load_av_time_data(tids_clean, tracks)
+    print_av_load_report(data_av_clean, av_report)
+
+    with stage(profiler, "load_genres"):
+        data_genres = load_genres(data_dir)
+        data_genres = data_genres[data_genres.index.isin(tids_clean)].copy()
+        genre_index = GenreIndex(data_genres)
+
+    return {
+        "data": data,
+        "tracks": tracks,
+        "data_av_clean": data_av_clean,
+        "av_version": av_report["version"],
+        "data_genres": data_genres,
+        "genre_index": genre_index,
+    }
+
 
-    data_quadrants = {
-        q: get_quadrant_ids(data_genre, q, p_norm_field)
-        for q in ("A+V+", "A-V+", "A+V-", "A-V-")
+def preprocess_inputs(args, inputs: dict, profiler: StageProfiler = None) -> dict:
+    """Smooth, decimate and normalize the AV trajectories for a configuration."""
+
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    with stage(profiler, "preprocess"):
+        data_av_decimated = preprocess_av_data(
+            inputs["data_av_clean"],
+            args.smoothing_sigma,
+            args.decimate_factor,
+            args.norm,
+            cache_dir=cache_dir,
+            profiler=profiler,
+            source_version=inputs["av_version"],
+        )
+    if args.max_length is not None:
+        max_length = args.max_length
+        if max_length == "auto":
+            max_length = auto_max_length(data_av_decimated)
+            print(f"Limiting the trajectories to {max_length} frames.")
+        data_av_decimated = limit_length(
+            data_av_decimated, max_length, args.max_length_mode
+        )
+    if cache_dir is not None:
+        evict_cache(
+            cache_dir,
+            max_size_bytes=int(args.cache_max_size * 1024**3),
+            max_age_days=args.cache_max_age,
+        )
+
+    return data_av_decimated
+
+
+def run_clustering(
+    args,
+    inputs: dict,
+    data_av_decimated: dict,
+    data_dir: Path,
+    profiler: StageProfiler = None,
+):
+    """Cluster every genre for a configuration and save `candidates.json`.
+
+    The stages recorded by `profiler` and by the genre workers are saved to
+    `profile.json` in the results directory.
+    """
+
+    if profiler is None:
+        profiler = StageProfiler()
+
+    results_dir = get_results_dir(args, data_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+
+    data_genres = inputs["data_genres"]
+
+    genres = set(data_genres.columns)
+    genres_blacklist = set(["Non-Music", "Stage & Screen", "Children's"])
+    genres_good = sorted(genres - genres_blacklist)
+
+    shared.update(
+        args=args,
+        distance_cache_params={
+            "smoothing_sigma": args.smoothing_sigma,
+            "decimate_factor": args.decimate_factor,
+            "norm": args.norm,
+            "metric_params": dtw_metric_params(
+                args.global_constraint,
+                args.sakoe_chiba_radius,
+                args.itakura_max_slope,
+            ),
+        },
+        data=inputs["data"],
+        data_genres=data_genres,
+        genre_index=inputs["genre_index"],
+        data_av_decimated=data_av_decimated,
+        tracks=inputs["tracks"],
+        results_dir=results_dir,
+        params_hash=params_hash(args),
+    )
+
+    if args.jobs > 1:
+        with ProcessPoolExecutor(
+            max_workers=args.jobs, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            results = list(executor.map(process_genre, genres_good))
+    else:
+        results = [process_genre(genre) for genre in genres_good]
+
+    genres_processed = []
+    for genre, (selection, stages) in zip(genres_good, results):
+        profiler.stages.extend(stages)
+        if selection is not None:
+            genres_processed.append(genre)
+
+    if args.engine == "dtw-kmedoids":
+        evict_distance_cache(
+            args.distance_cache_dir,
+            max_size_bytes=int(args.distance_cache_max_size * 1024**3),
+            max_age_days=args.distance_cache_max_age,
+        )
+
+    if not args.no_plots:
+        # also plot the genres of an interrupted run that were not plotted
+        genres_plot = [
+            genre
+            for genre in genres_good
+            if genre in genres_processed
+            or not scatter_file(results_dir, genre).exists()
+        ]
+        # matplotlib and seaborn are only imported when plotting
+        from plot_clusters import plot_genres
+
+        with profiler.stage("plot"):
+            plot_genres(results_dir, genres_plot, args.jobs)
+
+    # rebuild the candidates from the checkpoints of all the genres
+    data_out = {
+        genre: load_checkpoint(results_dir, genre)["selection"]
+        for genre in genres_good
     }
 
-    for q, yids in data_quadrants.items():
-        print(f"{q} has {len(yids)} ids.")
+    print("Save resulting list of candidates")
+    with profiler.stage("write_json"):
+        save_json_atomic(results_dir / "candidates.json", data_out)
+
+    profiler.print_summary()
+    profiler.save(results_dir / "profile.json", params=vars(args))
+
+
+def main():
+    args = parse_args()
+    data_dir = Path("data/")
 
-results_file = results_dir / "candidates.json"
-if results_file.exists():
-    with open(results_file, "r") as f:
-        data_out = json.load(f)
-else:
-    data_out = dict()
+    profiler = StageProfiler()
+    inputs = load_inputs(args, data_dir, profiler)
+    data_av_decimated = preprocess_inputs(args, inputs, profiler)
+    run_clustering(args, inputs, data_av_decimated, data_dir, profiler)
 
-for k, v in data_selected.items():
-    data_out[k] = dict()
-    for k2, v2 in v.items():
-        data_out[k][k2] = list(v2.index)
+    print("done!")
 
-print("Save resulting list of candidates")
-with open(results_dir / "candidates.json", "w") as f:
-    json.dump(data_out, f)
 
-print("done!")
+if __name__ == "__main__":
+    main()
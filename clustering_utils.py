@@ -0,0 +1,582 @@
+import fcntl
+import hashlib
+import heapq
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from tslearn.metrics import GLOBAL_CONSTRAINT_CODE, cdist_dtw, compute_mask, dtw
+from tslearn.utils import to_time_series_dataset
+
+from av_store import cache_key, lru_to_evict
+from io_utils import save_jsonl_atomic, write_atomic
+
+# Helpers for the clustering of the AV trajectories in `clustering.py`.
+
+GLOBAL_CONSTRAINTS = ("none", "sakoe_chiba", "itakura")
+
+DTW_DISTANCE_CACHE_DIR = Path("data/cache/dtw_distances/")
+DTW_CACHE_MANIFEST_FILE = "manifest.jsonl"
+DTW_CACHE_LOCK_FILE = ".lock"
+
+
+def dtw_metric_params(
+    global_constraint: str = "none",
+    sakoe_chiba_radius: int = None,
+    itakura_max_slope: float = None,
+) -> dict:
+    """Return the tslearn `metric_params` for a DTW global constraint."""
+
+    if global_constraint == "sakoe_chiba":
+        return {
+            "global_constraint": "sakoe_chiba",
+            "sakoe_chiba_radius": sakoe_chiba_radius,
+        }
+    if global_constraint == "itakura":
+        return {"global_constraint": "itakura", "itakura_max_slope": itakura_max_slope}
+    if global_constraint == "none":
+        return dict()
+
+    raise ValueError(f"Unknown global constraint {global_constraint}")
+
+
+def strip_padding(ts: np.ndarray) -> np.ndarray:
+    """Remove the NaN padding added by `to_time_series_dataset`."""
+
+    return ts[~np.isnan(ts).any(axis=1)]
+
+
+def _window_extrema(
+    values: np.ndarray, lo: np.ndarray, hi: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the min and max of `values[lo[i] : hi[i] + 1]` for every `i`.
+
+    Uses a sparse table of the min and max over windows of length `2**k`, so any
+    window is covered by two overlapping lookups.
+    """
+
+    mins, maxs = [values], [values]
+    span = 1
+    while 2 * span <= len(values):
+        mins.append(np.minimum(mins[-1][:-span], mins[-1][span:]))
+        maxs.append(np.maximum(maxs[-1][:-span], maxs[-1][span:]))
+        span *= 2
+
+    level = np.floor(np.log2(hi - lo + 1)).astype(np.int64)
+    lower = np.empty((len(lo), values.shape[1]), dtype=values.dtype)
+    upper = np.empty_like(lower)
+    for k in np.unique(level):
+        rows = np.flatnonzero(level == k)
+        start, end = lo[rows], hi[rows] - 2**k + 1
+        lower[rows] = np.minimum(mins[k][start], mins[k][end])
+        upper[rows] = np.maximum(maxs[k][start], maxs[k][end])
+
+    return lower, upper
+
+
+def lb_keogh_envelope(
+    center: np.ndarray, query_length: int, metric_params: dict
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the LB_Keogh envelope of `center` for queries of `query_length`.
+
+    For each query frame, the envelope is the per-dimension min and max of the
+    center frames it can be aligned with under the DTW global constraint, so it
+    also applies to series of different lengths. Without constraint, it is the
+    min and max of the whole center.
+    """
+
+    constraint = metric_params.get("global_constraint")
+    center_length = len(center)
+
+    if constraint is None:
+        lower = np.broadcast_to(center.min(axis=0), (query_length, center.shape[1]))
+        upper = np.broadcast_to(center.max(axis=0), (query_length, center.shape[1]))
+        return lower, upper
+
+    rows = np.arange(query_length)
+    if constraint == "sakoe_chiba":
+        # band of `sakoe_chiba_mask`, widened by the difference of the lengths
+        radius = metric_params.get("sakoe_chiba_radius") or 1
+        stretch = abs(query_length - center_length)
+        if query_length > center_length:
+            lo, hi = rows - stretch - radius, rows + radius
+        else:
+            lo, hi = rows - radius, rows + stretch + radius
+        lo = np.clip(lo, 0, center_length - 1)
+        hi = np.clip(hi, 0, center_length - 1)
+
+    else:
+        mask = compute_mask(
+            query_length,
+            center_length,
+            GLOBAL_CONSTRAINT_CODE[constraint],
+            itakura_max_slope=metric_params.get("itakura_max_slope"),
+        )
+        # each row of the parallelogram is a contiguous range of center frames
+        lo = mask.argmax(axis=1)
+        hi = center_length - 1 - mask[:, ::-1].argmax(axis=1)
+
+    return _window_extrema(center, lo, hi)
+
+
+def lb_keogh(query: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> float:
+    """Lower bound of the DTW distance between `query` and the envelope's center.
+
+    Every query frame is aligned with at least one center frame inside the
+    envelope, so the distance to the envelope never exceeds the DTW distance.
+    """
+
+    excess = np.maximum(query - upper, 0) + np.maximum(lower - query, 0)
+    return float(np.sqrt(np.sum(excess**2)))
+
+
+class LBKeoghIndex:
+    """LB_Keogh bounds between a set of centers and queries of any length.
+
+    Envelopes are computed once per (query length, center) and reused.
+    """
+
+    def __init__(self, centers: list, metric_params: dict):
+        self.centers = [strip_padding(c) for c in centers]
+        self.metric_params = metric_params
+        self.envelopes = dict()
+
+    def bounds(self, query: np.ndarray) -> np.ndarray:
+        """Return the lower bounds between `query` and every center."""
+
+        length = len(query)
+        if length not in self.envelopes:
+            self.envelopes[length] = [
+                lb_keogh_envelope(c, length, self.metric_params) for c in self.centers
+            ]
+
+        return np.array(
+            [lb_keogh(query, *envelope) for envelope in self.envelopes[length]]
+        )
+
+    def distance(self, query: np.ndarray, i_center: int) -> float:
+        """Exact DTW distance between `query` and a center."""
+
+        return dtw(query, self.centers[i_center], **self.metric_params)
+
+
+def nearest_series(
+    X: list, center: np.ndarray, n: int, metric_params: dict
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """Find the `n` series of `X` closest to `center` by DTW, with LB_Keogh pruning.
+
+    Series are visited by increasing lower bound and the search stops as soon as
+    the bound exceeds the n-th best distance found.
+    Returns the indices sorted by distance, their distances and the number of
+    DTW computations.
+    """
+
+    index = LBKeoghIndex([center], metric_params)
+    X = [strip_padding(query) for query in X]
+    bounds = np.array([index.bounds(query)[0] for query in X])
+
+    # max-heap of the n best (-distance, -i) pairs
+    best = []
+    n_dtw = 0
+    for i in np.argsort(bounds, kind="stable"):
+        if len(best) == n and bounds[i] >= -best[0][0]:
+            break
+        distance = index.distance(X[i], 0)
+        n_dtw += 1
+        if len(best) < n:
+            heapq.heappush(best, (-distance, -i))
+        elif distance < -best[0][0]:
+            heapq.heapreplace(best, (-distance, -i))
+
+    best = sorted((-d, -i) for d, i in best)
+    indices = np.array([i for _, i in best], dtype=np.int64)
+    distances = np.array([d for d, _ in best])
+
+    return indices, distances, n_dtw
+
+
+def album_ranks(album_ids: np.ndarray) -> np.ndarray:
+    """Return the rank of each track within its album, in order of appearance."""
+
+    album_ids = np.asarray(album_ids)
+    order = np.argsort(album_ids, kind="stable")
+    albums_sorted = album_ids[order]
+
+    is_start = np.ones(len(order), dtype=bool)
+    is_start[1:] = albums_sorted[1:] != albums_sorted[:-1]
+    starts = np.maximum.accumulate(np.where(is_start, np.arange(len(order)), 0))
+
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - starts
+    return ranks
+
+
+def album_cap_select(
+    album_ids: np.ndarray, n_min: int, max_cap: int = 9
+) -> tuple[np.ndarray, int]:
+    """Keep at most `cap` tracks per album, with the smallest cap keeping `n_min` tracks.
+
+    Tracks are kept in order of appearance within each album. If no cap up to
+    `max_cap` keeps enough tracks, `max_cap` is used.
+    Returns the mask of kept tracks and the cap.
+    """
+
+    ranks = album_ranks(album_ids)
+
+    # number of tracks kept with a cap of 1, 2, ..., max_cap
+    n_kept = np.cumsum(np.bincount(ranks, minlength=max_cap)[:max_cap])
+    enough = np.flatnonzero(n_kept >= n_min)
+    cap = enough[0] + 1 if len(enough) else max_cap
+
+    return ranks < cap, int(cap)
+
+
+class RaggedTrajectories:
+    """Variable-length trajectories stored contiguously in float32.
+
+    Unlike the NaN-padded float64 arrays of `to_time_series_dataset`, the memory
+    used is proportional to the total number of frames, not to the number of
+    trajectories times the longest one.
+    """
+
+    def __init__(self, trajectories: list):
+        lengths = np.array([len(ts) for ts in trajectories], dtype=np.int64)
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(lengths)
+        self.values = np.concatenate(trajectories).astype(np.float32, copy=False)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i = i % len(self)
+        return self.values[self.offsets[i] : self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def padded(self) -> np.ndarray:
+        """Return the NaN-padded dataset expected by tslearn, in float32."""
+
+        X = np.full(
+            (len(self), self.lengths.max(), self.values.shape[1]),
+            np.nan,
+            dtype=np.float32,
+        )
+        for i, ts in enumerate(self):
+            X[i, : len(ts)] = ts
+        return X
+
+
+def resample(ts: np.ndarray, length: int) -> np.ndarray:
+    """Linearly resample a trajectory to `length` frames."""
+
+    source = np.linspace(0, 1, len(ts))
+    target = np.linspace(0, 1, length)
+    return np.stack(
+        [np.interp(target, source, ts[:, d]) for d in range(ts.shape[1])], axis=1
+    ).astype(ts.dtype, copy=False)
+
+
+def resample_trajectories(X: list, length: int) -> np.ndarray:
+    """Linearly resample each (padded) trajectory of `X` to `length` frames.
+
+    Returns an array of shape (n_series, length, n_dims).
+    """
+
+    return np.array([resample(strip_padding(ts), length) for ts in X], dtype=np.float32)
+
+
+def limit_length(data: dict, max_length: int, mode: str = "cap") -> dict:
+    """Limit the trajectories to `max_length` frames.
+
+    With `cap`, longer trajectories are truncated to their first `max_length` frames,
+    with `resample`, they are linearly resampled to `max_length` frames.
+    """
+
+    if mode == "cap":
+        return {k: v[:max_length] for k, v in data.items()}
+    if mode == "resample":
+        return {
+            k: resample(v, max_length) if len(v) > max_length else v
+            for k, v in data.items()
+        }
+
+    raise ValueError(f"Unknown length limit mode {mode}")
+
+
+def auto_max_length(data: dict, quantile: float = 0.99) -> int:
+    """Return a `quantile` of the trajectory lengths, to bound the padded batches."""
+
+    return int(np.ceil(np.quantile([len(v) for v in data.values()], quantile)))
+
+
+def max_length_arg(value: str):
+    """Parse `--max-length`, a number of frames or `auto`."""
+
+    return value if value == "auto" else int(value)
+
+
+def trajectory_fingerprints(data: dict, tids: list) -> np.ndarray:
+    """Return a 64-bit content hash of each trajectory."""
+
+    return np.array(
+        [
+            int.from_bytes(
+                hashlib.blake2b(
+                    np.ascontiguousarray(data[tid], dtype=np.float32).tobytes(),
+                    digest_size=8,
+                ).digest(),
+                "little",
+            )
+            for tid in tids
+        ],
+        dtype=np.uint64,
+    )
+
+
+@contextmanager
+def _cache_lock(cache_dir: Path):
+    """Lock a DTW distance cache directory against concurrent writers."""
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open(cache_dir / DTW_CACHE_LOCK_FILE, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_manifest(cache_dir: Path) -> dict:
+    """Return the tids of every block of a DTW distance cache, by block file name."""
+
+    manifest_file = cache_dir / DTW_CACHE_MANIFEST_FILE
+    if not manifest_file.exists():
+        return dict()
+
+    blocks = dict()
+    with open(manifest_file, "r") as f:
+        for line in f:
+            # a record being appended
+            if not line.endswith("\n"):
+                break
+            entry = json.loads(line)
+            blocks[entry["block"]] = np.asarray(entry["tids"], dtype=np.int64)
+
+    return blocks
+
+
+class DTWDistanceCache:
+    """Persistent cache of pairwise DTW distances between tracks.
+
+    Entries are grouped in a directory per set of `params` (the preprocessing and
+    DTW parameters). Each call stores the pairs it computed as a new block holding
+    the tids of every pair, the fingerprints of their trajectories and their
+    distance, so that pairs shared by different genres or runs are reused as long as
+    the trajectories did not change. A manifest lists the tids of every block, so
+    only the blocks sharing pairs with a query are read.
+    """
+
+    def __init__(self, cache_dir: Path, params: dict):
+        self.params = params
+        self.cache_dir = Path(cache_dir) / cache_key(params)
+
+    def _fill_from_blocks(
+        self, distances: np.ndarray, tids: np.ndarray, fingerprints: np.ndarray
+    ) -> None:
+        """Fill `distances` with the pairs found in the stored blocks."""
+
+        order = np.argsort(tids)
+        tids_sorted = tids[order]
+
+        for name, block_tids in _read_manifest(self.cache_dir).items():
+            if np.isin(block_tids, tids_sorted).sum() < 2:
+                continue
+
+            block_file = self.cache_dir / name
+            try:
+                with np.load(block_file) as block:
+                    pair_tids = block["tids"]
+                    pair_fingerprints = block["fingerprints"]
+                    pair_distances = block["distances"]
+            except FileNotFoundError:
+                # evicted since the manifest was read
+                continue
+            # the access time of the block, for the eviction
+            os.utime(block_file)
+
+            pos = np.minimum(np.searchsorted(tids_sorted, pair_tids), len(tids) - 1)
+            rows = order[pos]
+            # only reuse the distances of unchanged trajectories
+            found = (tids_sorted[pos] == pair_tids) & (
+                fingerprints[rows] == pair_fingerprints
+            )
+            found = found.all(axis=1)
+
+            rows = rows[found]
+            distances[rows[:, 0], rows[:, 1]] = pair_distances[found]
+            distances[rows[:, 1], rows[:, 0]] = pair_distances[found]
+
+    def _save_block(
+        self,
+        tids: np.ndarray,
+        fingerprints: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        distances: np.ndarray,
+    ) -> None:
+        """Store the computed pairs `(rows, cols)` as a new block."""
+
+        pair_tids = np.stack([tids[rows], tids[cols]], axis=1)
+        pair_fingerprints = np.stack([fingerprints[rows], fingerprints[cols]], axis=1)
+        name = hashlib.blake2b(
+            pair_tids.tobytes() + pair_fingerprints.tobytes(), digest_size=16
+        ).hexdigest()
+        name = f"{name}.npz"
+
+        with _cache_lock(self.cache_dir):
+            with open(self.cache_dir / "params.json", "w") as f:
+                json.dump(self.params, f)
+
+            write_atomic(
+                self.cache_dir / name,
+                lambda tmp_path: np.savez(
+                    tmp_path,
+                    tids=pair_tids,
+                    fingerprints=pair_fingerprints,
+                    distances=distances.astype(np.float32),
+                ),
+            )
+            # the block is listed once complete
+            with open(self.cache_dir / DTW_CACHE_MANIFEST_FILE, "a") as f:
+                entry = {"block": name, "tids": np.unique(pair_tids).tolist()}
+                f.write(json.dumps(entry) + "\n")
+
+    def distance_matrix(
+        self, data: dict, tids: list, metric_params: dict
+    ) -> np.ndarray:
+        """Return the DTW distance matrix between the trajectories of `tids`.
+
+        Only the pairs missing from the cache are computed.
+        """
+
+        tids = np.asarray(tids, dtype=np.int64)
+        fingerprints = trajectory_fingerprints(data, tids)
+
+        distances = np.full((len(tids), len(tids)), np.nan)
+        np.fill_diagonal(distances, 0)
+        self._fill_from_blocks(distances, tids, fingerprints)
+
+        rows, cols = np.nonzero(np.triu(np.isnan(distances), k=1))
+        print(
+            f"DTW distance cache: {len(rows)}/{len(tids) * (len(tids) - 1) // 2} pairs to compute."
+        )
+        if len(rows) == 0:
+            return distances
+
+        X = [np.asarray(data[tid]) for tid in tids]
+        if len(rows) == len(tids) * (len(tids) - 1) // 2:
+            distances = cdist_dtw(to_time_series_dataset(X), **metric_params)
+        else:
+            for i, j in zip(rows, cols):
+                distances[i, j] = distances[j, i] = dtw(X[i], X[j], **metric_params)
+
+        self._save_block(tids, fingerprints, rows, cols, distances[rows, cols])
+
+        return distances
+
+
+def evict_distance_cache(
+    cache_dir: Path,
+    max_size_bytes: int = None,
+    max_age_days: float = None,
+) -> list:
+    """Remove the DTW distance blocks not accessed in `max_age_days`, then the least
+    recently used ones until the cache fits in `max_size_bytes`.
+
+    Returns the removed block files.
+    """
+
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists():
+        return []
+
+    entries = []
+    for block_file in cache_dir.glob("*/[!.]*.npz"):
+        stat = block_file.stat()
+        entries.append((stat.st_mtime, stat.st_size, block_file))
+
+    removed = lru_to_evict(entries, max_size_bytes, max_age_days)
+
+    for params_dir in {block_file.parent for block_file in removed}:
+        names = {f.name for f in removed if f.parent == params_dir}
+        print(f"Evicting {len(names)} DTW distance blocks from {params_dir}")
+        with _cache_lock(params_dir):
+            for name in names:
+                (params_dir / name).unlink(missing_ok=True)
+
+            blocks = _read_manifest(params_dir)
+            save_jsonl_atomic(
+                params_dir / DTW_CACHE_MANIFEST_FILE,
+                [
+                    {"block": name, "tids": tids.tolist()}
+                    for name, tids in blocks.items()
+                    if name not in names
+                ],
+            )
+
+    return removed
+
+
+def kmedoids(
+    distances: np.ndarray, n_clusters: int, random_state: int = 0, max_iter: int = 100
+) -> tuple[np.ndarray, np.ndarray]:
+    """Cluster a precomputed distance matrix with k-medoids.
+
+    Medoids are initialized with k-medoids++ and refined by alternating the
+    assignment to the closest medoid and the choice of the member minimizing the
+    sum of distances within each cluster.
+    Returns the medoid indices and the labels.
+    """
+
+    rng = np.random.default_rng(random_state)
+    n_samples = len(distances)
+
+    medoids = [rng.integers(n_samples)]
+    for _ in range(1, n_clusters):
+        closest = distances[:, medoids].min(axis=1) ** 2
+        if closest.sum() == 0:
+            candidates = np.setdiff1d(np.arange(n_samples), medoids)
+            medoids.append(rng.choice(candidates))
+        else:
+            medoids.append(rng.choice(n_samples, p=closest / closest.sum()))
+    medoids = np.array(medoids)
+
+    for _ in range(max_iter):
+        labels = distances[:, medoids].argmin(axis=1)
+
+        new_medoids = medoids.copy()
+        for k in range(n_clusters):
+            members = np.nonzero(labels == k)[0]
+            if len(members) == 0:
+                continue
+            costs = distances[np.ix_(members, members)].sum(axis=1)
+            new_medoids[k] = members[np.argmin(costs)]
+
+        if np.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+
+    labels = distances[:, medoids].argmin(axis=1)
+
+    return medoids, labels
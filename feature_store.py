@@ -0,0 +1,273 @@
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columnar store of the track-level predictions.
+# The wide predictions TSV and the AV and algorithms pickles are merged once into a
+# single Parquet file indexed by the integer tid, so that loaders can read only the
+# columns they need.
+
+DATA_DIR = Path("data/")
+FEATURES_FILE = "mtg-jamendo-predictions.parquet"
+GENRES_FILE = "mtg-jamendo-genres.parquet"
+
+STYLE_PREFIX = "genre_discogs400-discogs-effnet-1"
+
+# original files merged into the features store
+SOURCE_FILES = (
+    "mtg-jamendo-predictions.tsv",
+    "mtg-jamendo-predictions-av.pk",
+    "mtg-jamendo-predictions-algos.pk",
+)
+# key of the source stamp in the Parquet metadata of the features store
+SOURCE_METADATA_KEY = b"source"
+
+
+def read_raw_data(data_dir: Path = DATA_DIR) -> pd.DataFrame:
+    """Read and merge the original predictions TSV and pickles."""
+
+    models_file, av_file, algos_file = (data_dir / name for name in SOURCE_FILES)
+    data_models = pd.read_csv(models_file, sep="\t", index_col=0)
+    data_av = pd.read_pickle(av_file)
+    data_algos = pd.read_pickle(algos_file)
+
+    data = pd.concat([data_models, data_av, data_algos], axis=1)
+    data.index = data.index.str.split("/").str[1].astype(np.int64)
+    data.index.name = "tid"
+
+    return data
+
+
+def source_stamp(data_dir: Path = DATA_DIR) -> dict:
+    """Identify a version of the original predictions files."""
+
+    stamp = dict()
+    for name in SOURCE_FILES:
+        stat = (Path(data_dir) / name).stat()
+        stamp[name] = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    return stamp
+
+
+def downcast_floats(data: pd.DataFrame, dtype=np.float32) -> pd.DataFrame:
+    """Cast the floating point columns of `data` to `dtype`."""
+
+    float_columns = data.select_dtypes(include="floating").columns
+    if len(float_columns) == 0:
+        return data
+
+    return data.astype({c: dtype for c in float_columns}, copy=False)
+
+
+def build_feature_store(data_dir: Path = DATA_DIR) -> Path:
+    """Convert the original predictions files into the columnar store."""
+
+    stamp = source_stamp(data_dir)
+    data = downcast_floats(read_raw_data(data_dir))
+
+    # the stamp of the original files is kept in the Parquet metadata
+    table = pa.Table.from_pandas(data, preserve_index=True)
+    metadata = dict(table.schema.metadata or dict())
+    metadata[SOURCE_METADATA_KEY] = json.dumps(stamp).encode()
+
+    features_file = data_dir / FEATURES_FILE
+    pq.write_table(table.replace_schema_metadata(metadata), features_file)
+    print(f"Wrote {data.shape[0]} tracks x {data.shape[1]} features to {features_file}")
+
+    return features_file
+
+
+def is_feature_store_up_to_date(data_dir: Path = DATA_DIR) -> bool:
+    """Check whether the features store was built from the current original files."""
+
+    features_file = data_dir / FEATURES_FILE
+    if not features_file.exists():
+        return False
+
+    metadata = pq.read_schema(features_file).metadata or dict()
+    if SOURCE_METADATA_KEY not in metadata:
+        return False
+
+    return json.loads(metadata[SOURCE_METADATA_KEY]) == source_stamp(data_dir)
+
+
+def select_columns(
+    available: list,
+    columns: list = None,
+    like: list = None,
+) -> list:
+    """Select the available columns listed in `columns` or containing any of `like`."""
+
+    if columns is None and like is None:
+        return list(available)
+
+    columns = set(columns or [])
+    like = like or []
+
+    return [
+        c for c in available if c in columns or any(pattern in c for pattern in like)
+    ]
+
+
+def load_data(
+    data_dir: Path = DATA_DIR,
+    columns: list = None,
+    like: list = None,
+    dtype=np.float32,
+) -> pd.DataFrame:
+    """Load the predictions table indexed by integer tid.
+
+    Only the columns named in `columns` or containing one of the substrings in `like`
+    are read (all of them if both are `None`). Floating point columns are returned
+    as `dtype`. The columnar store is (re)built when missing or when the original
+    files changed.
+    """
+
+    features_file = data_dir / FEATURES_FILE
+    if not is_feature_store_up_to_date(data_dir):
+        print(f"Building {features_file} from the original files.")
+        build_feature_store(data_dir)
+
+    schema = pq.read_schema(features_file)
+    index_columns = schema.pandas_metadata["index_columns"]
+    available = [c for c in schema.names if c not in index_columns]
+
+    data = pd.read_parquet(
+        features_file, columns=select_columns(available, columns, like)
+    )
+
+    return downcast_floats(data, dtype)
+
+
+# AV quadrants and their (start, end] angle ranges in the valence-arousal plane
+QUADRANTS = {
+    "A+V+": (0, np.pi / 2),
+    "A-V+": (-np.pi / 2, 0),
+    "A+V-": (np.pi / 2, np.pi),
+    "A-V-": (-np.pi, -np.pi / 2),
+}
+
+
+def add_av_columns(data: pd.DataFrame, av_model: str = "emomusic") -> pd.DataFrame:
+    """Add the normalized, polar and quadrant AV columns to `data`.
+
+    Valence and arousal are mapped from [1, 9] to [-1, 1] (`-norm` columns), then
+    converted to polar coordinates (`av-radius-norm`, `av-angle-norm`) and to their
+    quadrant (`av-quadrant`).
+    """
+
+    prefix = f"{av_model}-msd-musicnn-2---"
+
+    valence = (data[f"{prefix}valence"] - 5) / 4
+    arousal = (data[f"{prefix}arousal"] - 5) / 4
+    angle = np.arctan2(arousal, valence)
+
+    quadrants = np.full(len(data), None, dtype=object)
+    for quadrant, (start, end) in QUADRANTS.items():
+        quadrants[(angle > start) & (angle <= end)] = quadrant
+
+    data[f"{prefix}valence-norm"] = valence
+    data[f"{prefix}arousal-norm"] = arousal
+    data[f"{prefix}av-radius-norm"] = np.hypot(valence, arousal)
+    data[f"{prefix}av-angle-norm"] = angle
+    data[f"{prefix}av-quadrant"] = pd.Categorical(quadrants, categories=list(QUADRANTS))
+
+    return data
+
+
+def build_genre_store(data_dir: Path = DATA_DIR) -> Path:
+    """Reduce the Discogs style activations to their parent genres and save them.
+
+    The activation of a genre is the maximum over its styles
+    (`genre_discogs400-discogs-effnet-1---<genre>---<style>` columns).
+    """
+
+    data_styles = load_data(data_dir, like=[STYLE_PREFIX])
+    styles = data_styles.columns
+    genres = styles.str.split("---").str[1].to_numpy()
+
+    # sort the columns by genre so that each genre is a contiguous group
+    order = np.argsort(genres, kind="stable")
+    genres_sorted = genres[order]
+    is_start = np.ones(len(genres_sorted), dtype=bool)
+    is_start[1:] = genres_sorted[1:] != genres_sorted[:-1]
+    starts = np.flatnonzero(is_start)
+
+    values = data_styles.to_numpy()[:, order]
+    data_genres = pd.DataFrame(
+        np.fmax.reduceat(values, starts, axis=1),
+        index=data_styles.index,
+        columns=genres_sorted[starts],
+    )
+
+    genres_file = data_dir / GENRES_FILE
+    data_genres.to_parquet(genres_file, index=True)
+    print(f"Wrote {data_genres.shape[1]} genres to {genres_file}")
+
+    return genres_file
+
+
+def load_genres(data_dir: Path = DATA_DIR) -> pd.DataFrame:
+    """Load the parent genre activations indexed by integer tid.
+
+    The genre store is (re)built when missing or older than the features store.
+    """
+
+    genres_file = data_dir / GENRES_FILE
+    features_file = data_dir / FEATURES_FILE
+    if (
+        not genres_file.exists()
+        or not features_file.exists()
+        or genres_file.stat().st_mtime < features_file.stat().st_mtime
+    ):
+        build_genre_store(data_dir)
+
+    return pd.read_parquet(genres_file)
+
+
+class GenreIndex:
+    """Per-genre sorted activations, to find the tids above a threshold by bisection."""
+
+    def __init__(self, data_genres: pd.DataFrame):
+        self.tids = data_genres.index.to_numpy()
+        self.genres = {genre: i for i, genre in enumerate(data_genres.columns)}
+
+        values = np.nan_to_num(data_genres.to_numpy(), nan=-np.inf)
+        self.order = np.argsort(values, axis=0, kind="stable")
+        self.sorted_values = np.take_along_axis(values, self.order, axis=0)
+
+    def rows_above(self, genre: str, threshold: float) -> np.ndarray:
+        """Return the sorted row positions whose activation of `genre` is above `threshold`."""
+
+        i = self.genres[genre]
+        start = np.searchsorted(self.sorted_values[:, i], threshold, side="right")
+        return np.sort(self.order[start:, i])
+
+    def tids_above(self, genre: str, threshold: float) -> np.ndarray:
+        """Return the tids whose activation of `genre` is above `threshold`."""
+
+        return self.tids[self.rows_above(genre, threshold)]
+
+    def count_above(self, genre: str, threshold: float) -> int:
+        """Return the number of tids whose activation of `genre` is above `threshold`."""
+
+        i = self.genres[genre]
+        return len(self.tids) - np.searchsorted(
+            self.sorted_values[:, i], threshold, side="right"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Build the columnar predictions and genres stores from the original TSV and pickles."
+    )
+    parser.add_argument("--data-dir", type=Path, default=DATA_DIR)
+    args = parser.parse_args()
+
+    build_feature_store(args.data_dir)
+    build_genre_store(args.data_dir)
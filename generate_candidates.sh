@@ -7,8 +7,7 @@ source venv/bin/activate
 #
 n_samples=170
 
-python clustering.py --norm none --n-samples-per-genre $n_samples
-python clustering.py --norm zscore --n-samples-per-genre ${n_samples}
+python sweep.py --norm none zscore --n-samples-per-genre ${n_samples}
 
 python postprocess.py \
     data/clustering/clustering_genre_thres_0.1_n_samples_${n_samples}_smoothing_5_decimate_5_norm_none/candidates.json \
@@ -0,0 +1,49 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+# Atomic file writes shared by the pipeline and the apps: the data is written to a
+# temporary file in the same directory and moved in place, so readers never see a
+# partially written file.
+
+
+def write_atomic(path: Path, write) -> None:
+    """Call `write(tmp_path)` and move the temporary file to `path`."""
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique per process and thread, the apps write from several threads
+    tmp_name = f".{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp{path.suffix}"
+    tmp_path = path.with_name(tmp_name)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def save_json_atomic(path: Path, data) -> None:
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    write_atomic(path, write)
+
+
+def save_jsonl_atomic(path: Path, records: list) -> None:
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    write_atomic(path, write)
+
+
+def save_npy_atomic(path: Path, array: np.ndarray) -> None:
+    write_atomic(path, lambda tmp_path: np.save(tmp_path, array))
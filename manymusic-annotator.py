@@ -1,17 +1,14 @@
-import json
-import sys
 import uuid
 from pathlib import Path
-from datetime import datetime
 
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
 
 from utils import wavesurfer_play
-
-sys.path.append("mtg-jamendo-dataset/scripts/")
-import commons
+from tracks_table import load_tracks
+from chunk_store import load_chunk_index, load_chunk_tids
+from annotation_store import AnnotationJournal, JournalCache
 
 
 def generate_uuid():
@@ -22,8 +19,7 @@ def generate_uuid():
 def load_data():
     """Load and prepare ground truth in the streamlit cache."""
 
-    mtg_jamendo_file = "mtg-jamendo-dataset/data/autotagging.tsv"
-    tracks, _, _ = commons.read_file(mtg_jamendo_file)
+    tracks = load_tracks()
 
     integrated_loudness_file = "data/integrated_loudness.pk"
     integrated_loudness = pd.read_pickle(integrated_loudness_file)
@@ -36,64 +32,57 @@ def init():
     # Load ground truth data
     tracks, integrated_loudness = load_data()
 
-    preselection_data = pd.read_csv(preselection_data_file, sep="\t")
-    chunks = preselection_data["chunk_id"].unique()
+    chunks = list(load_chunk_index(preselection_data_file))
 
     integrated_loudness.index = [i.split("/")[1] for i in integrated_loudness.index]
 
-    return tracks, preselection_data, chunks, integrated_loudness
+    return tracks, chunks, integrated_loudness
+
+
+@st.cache_resource
+def user_data_cache() -> JournalCache:
+    """Journals of the users, shared by all the browser sessions."""
+
+    return JournalCache()
 
 
-@st.cache_resource(max_entries=1)
 def retrieve_user_data(
-    user_data_file: Path,
-    preselection_data: pd.DataFrame,
+    user_data_dir: Path,
     chunk_id: str,
-) -> dict:
-    """Retrieve user data from a file."""
+) -> AnnotationJournal:
+    """Retrieve user data, starting a new session if the user or the chunk changed."""
+
+    journal = user_data_cache().get(user_data_dir)
+
+    user_data_key = (str(user_data_dir), chunk_id)
+    if st.session_state.get("user_data_key") == user_data_key:
+        return journal
 
     print(f"Retrieving user data, for chunk {chunk_id}.")
 
     # Get the tids for the selected chunk
-    tids = list(
-        preselection_data[preselection_data["chunk_id"] == int(chunk_id)]["tid"]
-    )
+    tids = load_chunk_tids(preselection_data_file, chunk_id)
 
-    # Create a new annotation session
-    new_session = {
-        "start": datetime.now().isoformat(),
-        "end": datetime.now().isoformat(),
-        "chunk": chunk_id,
-        "uuid": st.session_state.user_uuid,
-    }
-
-    # Load user data
-    if user_data_file.exists():
-        with open(user_data_file, "r") as f:
-            user_data = json.load(f)
-
-        user_data["sessions"].append(new_session)
-    # Initialise chunk dictionary otherwise
-    else:
-        user_data = {
-            "annotations": dict(),
-            "sessions": [new_session],
-        }
+    with journal.lock:
+        # compact the records of the previous sessions
+        journal.compact()
 
-    if chunk_id not in user_data["annotations"]:
-        user_data["annotations"][chunk_id] = {k: dict() for k in tids}
+        # Create a new annotation session
+        journal.start_session(chunk_id, st.session_state.user_uuid)
 
-    # Set the tid index
-    tid_idx = 0
-    if chunk_id in user_data["annotations"]:
-        tid_idx = count_annotations(user_data["annotations"][chunk_id])
+        # Initialise chunk dictionary
+        journal.add_chunk(chunk_id, tids)
+
+        # Set the tid index
+        tid_idx = count_annotations(journal.user_data["annotations"][chunk_id])
 
     if tid_idx > 0:
         st.write(f" Resuming annotation of chunk `{chunk_id}` at track `{tid_idx}`")
 
     st.session_state.tid_idx = tid_idx
+    st.session_state.user_data_key = user_data_key
 
-    return user_data
+    return journal
 
 
 def count_annotations(chunk_data: dict):
@@ -104,6 +93,7 @@ def count_annotations(chunk_data: dict):
             i += 1
         else:
             return i
+    return i
 
 
 def next_track(
@@ -121,12 +111,7 @@ def next_track(
             st.write("Going to the previous track")
         return
 
-    user_data["annotations"][chunk_id][str(tid)] = {
-        "answer": answer,
-        "timestamp": str(datetime.now().isoformat()),
-    }
-
-    save_user_data(user_data, user_data_file)
+    user_data_cache().get(user_data_dir).record_answer(chunk_id, str(tid), answer)
 
     st.session_state.tid_idx += 1
 
@@ -152,19 +137,6 @@ def next_track(
         raise ValueError("Invalid answer.")
 
 
-def save_user_data(user_data, user_data_file):
-    """Save user data to a file."""
-
-    # update the end timestamp
-    user_data["sessions"][-1]["end"] = datetime.now().isoformat()
-
-    if not user_data_file.parent.exists():
-        user_data_file.parent.mkdir(parents=True)
-
-    with open(user_data_file, "w") as f:
-        json.dump(user_data, f)
-
-
 choices = {
     "all_good": "✅ all good (a)",
     "bad_audio": "🔇 bad audio (s)",
@@ -203,8 +175,8 @@ else:
     )
 
     # main program
-    user_data_file = Path("annotations", st.session_state.user_uuid, "annotations.json")
-    tracks, preselection_data, chunks, integrated_loudness = init()
+    user_data_dir = Path("annotations", st.session_state.user_uuid)
+    tracks, chunks, integrated_loudness = init()
 
     chunk_id = st.selectbox("Select a chunk to annotate", chunks)
     chunk_id = str(chunk_id)
@@ -225,7 +197,8 @@ else:
     )
 
     # load user data
-    user_data = retrieve_user_data(user_data_file, preselection_data, chunk_id)
+    journal = retrieve_user_data(user_data_dir, chunk_id)
+    user_data = journal.user_data
 
     tids = list(user_data["annotations"][chunk_id].keys())
     st.write(f"Track `{st.session_state.tid_idx}/{len(tids)}`")
@@ -274,8 +247,6 @@ else:
         args=[chunk_id, "previous", tid],
     )
 
-    save_user_data(user_data, user_data_file)
-
 
 # Add keyboard shortcuts with JS
 components.html(
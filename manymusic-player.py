@@ -1,41 +1,34 @@
 import json
 import math
-import sys
 from collections import Counter
 from pathlib import Path
 from glob import glob
 
 import numpy as np
-import pandas as pd
 import streamlit as st
 from matplotlib.image import imread
 
-from utils import load_av_time_data, smooth_data, plot_av, play, normalize_string
+from utils import (
+    load_av_time_data,
+    print_av_load_report,
+    smooth_data,
+    plot_av,
+    play,
+    normalize_string,
+)
+from tracks_table import load_tracks
 
-sys.path.append("mtg-jamendo-dataset/scripts/")
-import commons
 
 data_dir = Path("data/")
 
 tracks_per_page = 5
 
 
-@st.cache_data
-def load_data():
-    """Load and prepare ground truth in the streamlit cache."""
+@st.cache_resource
+def load_tracks_cached():
+    """Load the MTG Jamendo tracks table once per server."""
 
-    data_models = pd.read_csv(
-        data_dir / "mtg-jamendo-predictions.tsv", sep="\t", index_col=0
-    )
-    data_av = pd.read_pickle(data_dir / "mtg-jamendo-predictions-av.pk")
-    data_algos = pd.read_pickle(data_dir / "mtg-jamendo-predictions-algos.pk")
-
-    data = pd.concat([data_models, data_av, data_algos], axis=1)
-    data.index = pd.Index(map(lambda x: int(x.split("/")[1]), data.index))
-
-    mtg_jamendo_file = "mtg-jamendo-dataset/data/autotagging.tsv"
-    tracks, _, _ = commons.read_file(mtg_jamendo_file)
-    return data, tracks
+    return load_tracks()
 
 
 def get_top_tags(tids: list, n_most_common: int = 5):
@@ -48,7 +41,7 @@ def get_top_tags(tids: list, n_most_common: int = 5):
     return Counter(tags).most_common(n_most_common)
 
 
-_, tracks = load_data()
+tracks = load_tracks_cached()
 tids_init = set(tracks.keys())
 tids_clean = tids_init
 
@@ -63,8 +56,8 @@ st.write("## Loading list of candidates")
 with open(clustering_data_dir / "candidates.json", "r") as f:
     data = json.load(f)
 
-data_av_clean, tids_clean = load_av_time_data(tids_clean, tracks)
-print(f"Kept {len(data_av_clean)} samples")
+data_av_clean, av_report = load_av_time_data(tids_clean, tracks)
+print_av_load_report(data_av_clean, av_report)
 
 data_av_smooth = smooth_data(data_av_clean)
 
@@ -0,0 +1,83 @@
+import json
+import multiprocessing
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+from checkpoints import centers_file, scatter_file, selection_file
+
+# Scatter plots of the clustering results, drawn from the per-genre selection tables
+# and cluster centers saved by `clustering.py`, so they can be generated after the
+# clustering or regenerated without re-clustering.
+
+
+def plot_genre(results_dir: Path, genre: str) -> bool:
+    """Plot the AV scatter of a clustered genre.
+
+    Returns `False` if the genre has no saved selection table or centers.
+    """
+
+    if not selection_file(results_dir, genre).exists():
+        return False
+    if not centers_file(results_dir, genre).exists():
+        return False
+
+    selection = pd.read_parquet(selection_file(results_dir, genre))
+    centers = np.load(centers_file(results_dir, genre))
+    v_field, a_field = [c for c in selection.columns if c.endswith("-norm")]
+
+    fig, ax = plt.subplots()
+
+    for i_cluster, center in enumerate(centers):
+        center_mean = np.nanmean(center, axis=0)
+        ax.annotate(f"C{i_cluster}", (center_mean[0], center_mean[1]))
+
+    sns.scatterplot(
+        data=selection.sort_values("source", kind="stable"),
+        x=v_field,
+        y=a_field,
+        hue="source",
+    ).set_title(genre)
+
+    plt.axvline(0, color="k")
+    plt.axhline(0, color="k")
+
+    plt.savefig(scatter_file(results_dir, genre))
+    plt.close(fig)
+
+    return True
+
+
+def plot_genres(results_dir: Path, genres: list, jobs: int = 1) -> None:
+    """Plot the AV scatter of every clustered genre, with `jobs` processes."""
+
+    if jobs > 1:
+        with ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            list(executor.map(plot_genre, [results_dir] * len(genres), genres))
+    else:
+        for genre in genres:
+            plot_genre(results_dir, genre)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Plot the AV scatters of a clustering results directory."
+    )
+    parser.add_argument("results_dir", type=Path)
+    parser.add_argument("--jobs", "-j", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.results_dir / "candidates.json", "r") as f:
+        genres = list(json.load(f).keys())
+
+    plot_genres(args.results_dir, genres, args.jobs)
@@ -1,11 +1,16 @@
 import json
 from argparse import ArgumentParser
 import pandas as pd
-from collections import defaultdict
 from pathlib import Path
 import numpy as np
+from scipy import sparse
+
+from profiling import StageProfiler
+from chunk_store import balanced_chunks, write_chunks
+from tracks_table import AUDIO_PREVIEW_SECONDS, load_tracks
 
 # generate a tsv combining several output jsons. Optionally, the resulting dataset can be split into equally sized chunks.
+# The chunks are also saved in a per-chunk manifest read by the annotator.
 
 parser = ArgumentParser()
 parser.add_argument("jsons", nargs="+", help="List of json files to combine.")
@@ -13,50 +18,120 @@ parser.add_argument("--output", "-o", help="Output tsv file.")
 parser.add_argument(
     "--chunk-size", "-c", type=int, help="Split the dataset into chunks of this size."
 )
+parser.add_argument(
+    "--balance",
+    choices=["count", "duration"],
+    default="count",
+    help="Balance the chunks by number of tracks, or by listening time (the track "
+    "durations capped at the length of the audio previews).",
+)
+parser.add_argument(
+    "--stratify",
+    action="store_true",
+    help="With `--balance duration`, spread every genre and cluster evenly across "
+    "the chunks.",
+)
 
 args = parser.parse_args()
+if args.stratify and args.balance != "duration":
+    parser.error("--stratify requires --balance duration")
 
-clusters = ["av_cluster_0", "av_cluster_1", "av_cluster_2"]
-dfs = []
-for json_file in args.jsons:
-    with open(json_file) as f:
-        json_data = json.load(f)
-        file_stem = Path(json_file).stem
+profiler = StageProfiler()
 
-        genres = json_data.keys()
 
-        data = defaultdict(list)
+def cluster_order(cluster: str) -> int:
+    return int(cluster.rsplit("_", 1)[1])
+
+
+# every group of tids of the inputs, with its genre and its cluster (`None` for the
+# genres saved as plain lists)
+with profiler.stage("load_jsons"):
+    genres = dict()
+    clusters = dict()
+    tids_groups, genre_groups, cluster_groups = [], [], []
+    for json_file in args.jsons:
+        with open(json_file) as f:
+            json_data = json.load(f)
+
         for genre, values in json_data.items():
-            if isinstance(values, list):
-                tids = values
-                data["tid"].extend(tids)
-                for genre_i in genres:
-                    data[genre].extend([genre == genre_i] * len(tids))
-                for cluster_i in clusters:
-                    data[cluster_i].extend([False] * len(tids))
-            else:
-                for cluster, tids in values.items():
-                    data["tid"].extend(tids)
-                    for genre_i in genres:
-                        data[genre_i].extend([genre_i == genre] * len(tids))
-                    for cluster_i in clusters:
-                        data[cluster_i].extend([cluster_i == cluster] * len(tids))
-
-        df = pd.DataFrame(data)
-        # df.set_index("tid", inplace=True)
-        dfs.append(df)
-
-
-df = pd.concat(dfs, ignore_index=True)
-df = df.groupby(["tid"]).agg(lambda col: any(col)).reset_index()
+            groups = {None: values} if isinstance(values, list) else values
+            for cluster, tids in groups.items():
+                tids_groups.append(np.asarray(tids, dtype=np.int64))
+                genre_groups.append(genres.setdefault(genre, len(genres)))
+                if cluster is not None:
+                    cluster = clusters.setdefault(cluster, len(clusters))
+                cluster_groups.append(cluster)
+
+
+# OR-reduction of the memberships of all the inputs in a sparse tid x (genre, cluster)
+# matrix, the clusters in numerical order after the genres
+with profiler.stage("merge"):
+    tids = np.concatenate(tids_groups) if tids_groups else np.empty(0, np.int64)
+    tids_unique, rows = np.unique(tids, return_inverse=True)
+    group_sizes = [len(group) for group in tids_groups]
+
+    cluster_names = sorted(clusters, key=cluster_order)
+    cluster_cols = np.full(len(clusters) + 1, -1)
+    cluster_cols[[clusters[c] for c in cluster_names]] = len(genres) + np.arange(
+        len(clusters)
+    )
+
+    genre_cols = np.repeat(genre_groups, group_sizes).astype(int)
+    cluster_cols = np.repeat(
+        cluster_cols[[-1 if c is None else c for c in cluster_groups]], group_sizes
+    ).astype(int)
+    has_cluster = cluster_cols >= 0
+
+    membership = sparse.coo_matrix(
+        (
+            np.ones(len(rows) + has_cluster.sum(), dtype=np.int32),
+            (
+                np.concatenate([rows, rows[has_cluster]]),
+                np.concatenate([genre_cols, cluster_cols[has_cluster]]),
+            ),
+        ),
+        shape=(len(tids_unique), len(genres) + len(clusters)),
+    ).tocsr()
+
+    df = pd.DataFrame(membership.toarray() > 0, columns=list(genres) + cluster_names)
+    df.insert(0, "tid", tids_unique)
 
 
 if args.chunk_size:
     n_chunks = np.ceil(len(df) / args.chunk_size)
-    chunk_ids = np.repeat(np.arange(n_chunks, dtype=int), args.chunk_size)[: len(df)]
     df = df.sample(frac=1, random_state=42)
-    df["chunk_id"] = chunk_ids
+
+    if args.balance == "duration":
+        with profiler.stage("balance_chunks"):
+            listening_time = np.minimum(
+                load_tracks().durations(df["tid"]), AUDIO_PREVIEW_SECONDS
+            )
+            strata = None
+            if args.stratify:
+                strata = df.groupby(list(genres) + cluster_names).ngroup().to_numpy()
+
+            chunk_ids = balanced_chunks(listening_time, int(n_chunks), strata)
+            df["chunk_id"] = chunk_ids
+            df = df.sort_values("chunk_id", kind="stable")
+
+            chunk_minutes = np.bincount(chunk_ids, weights=listening_time) / 60
+            print(
+                f"{int(n_chunks)} chunks of {chunk_minutes.min():.1f} to "
+                f"{chunk_minutes.max():.1f} minutes of listening."
+            )
+    else:
+        chunk_ids = np.repeat(np.arange(n_chunks, dtype=int), args.chunk_size)
+        df["chunk_id"] = chunk_ids[: len(df)]
 
 
 # save the dataset
-df.to_csv(args.output, sep="\t", index=False)
+with profiler.stage("write_tsv"):
+    df.to_csv(args.output, sep="\t", index=False)
+
+if args.chunk_size:
+    with profiler.stage("write_chunks"):
+        write_chunks(df, args.output)
+
+output = Path(args.output)
+profiler.print_summary()
+profiler.save(output.with_name(f"{output.stem}_profile.json"), params=vars(args))
@@ -0,0 +1,174 @@
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+# Lightweight per-stage instrumentation of the candidate generation scripts.
+# Each stage records its wall time, CPU time and the peak RSS of the process during
+# the stage, and the records are saved as a JSON profile next to the results.
+# On Linux, the peak RSS is reset at the start of every stage (`/proc/self/clear_refs`),
+# elsewhere only the lifetime peak of the process is available.
+
+
+# peak RSS of the process before the last `reset_peak_rss`, which also resets
+# `ru_maxrss`
+_reset_peak_mb = 0.0
+
+
+def peak_rss_mb(children: bool = False) -> float:
+    """Return the peak resident set size of the current process in MB.
+
+    With `children`, return the largest peak of its terminated child processes.
+    """
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # `ru_maxrss` is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        max_rss = max_rss / 1024**2
+    else:
+        max_rss = max_rss / 1024
+    return max_rss if children else max(max_rss, _reset_peak_mb)
+
+
+def _status_mb(field: str) -> float:
+    """Return a memory field of `/proc/self/status` in MB, or `None`."""
+
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS of the current process to its current RSS (Linux only)."""
+
+    global _reset_peak_mb
+    _reset_peak_mb = peak_rss_mb()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def stage_peak_rss_mb() -> float:
+    """Return the peak RSS of the process since the last `reset_peak_rss`."""
+
+    peak = _status_mb("VmHWM")
+    return peak if peak is not None else peak_rss_mb()
+
+
+def rss_mb() -> float:
+    """Return the current RSS of the process, or its peak where it is not available."""
+
+    rss = _status_mb("VmRSS")
+    return rss if rss is not None else peak_rss_mb()
+
+
+class StageProfiler:
+    """Record the wall time, CPU time and peak RSS of named stages.
+
+    Stages can be nested: resetting the peak RSS at the start of an inner stage first
+    reports the peak reached so far to the enclosing stages.
+    """
+
+    def __init__(self, stages: list = None):
+        self.stages = stages if stages is not None else []
+        # running peak RSS of the open stages, innermost last
+        self._open_peaks = []
+
+    def _update_open_peaks(self, peak: float) -> None:
+        self._open_peaks = [max(p, peak) for p in self._open_peaks]
+
+    @contextmanager
+    def stage(self, name: str, **info):
+        """Time the enclosed block as stage `name`, with extra `info` fields."""
+
+        self._update_open_peaks(stage_peak_rss_mb())
+        reset_peak_rss()
+        rss_start = rss_mb()
+        self._open_peaks.append(rss_start)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall_s = time.perf_counter() - wall_start
+            cpu_s = time.process_time() - cpu_start
+
+            self._update_open_peaks(stage_peak_rss_mb())
+            peak = self._open_peaks.pop()
+            self.stages.append(
+                {
+                    "stage": name,
+                    **info,
+                    "wall_s": wall_s,
+                    "cpu_s": cpu_s,
+                    "rss_start_mb": rss_start,
+                    "peak_rss_mb": peak,
+                    "peak_rss_delta_mb": peak - rss_start,
+                    "pid": os.getpid(),
+                }
+            )
+
+    def summary(self) -> dict:
+        """Return the total wall and CPU time and the largest peak RSS per stage name."""
+
+        totals = defaultdict(
+            lambda: {"count": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_delta_mb": 0.0}
+        )
+        for record in self.stages:
+            total = totals[record["stage"]]
+            total["count"] += 1
+            total["wall_s"] += record["wall_s"]
+            total["cpu_s"] += record["cpu_s"]
+            total["peak_rss_delta_mb"] = max(
+                total["peak_rss_delta_mb"], record["peak_rss_delta_mb"]
+            )
+
+        return dict(totals)
+
+    def print_summary(self) -> None:
+        print("stage\tcount\twall_s\tcpu_s\tpeak_rss_delta_mb")
+        for name, total in self.summary().items():
+            print(
+                f"{name}\t{total['count']}\t{total['wall_s']:.2f}\t{total['cpu_s']:.2f}"
+                f"\t{total['peak_rss_delta_mb']:.1f}"
+            )
+
+    def save(self, profile_file: Path, params: dict = None) -> None:
+        """Save the stages and their summary as JSON."""
+
+        profile = {
+            "command": sys.argv,
+            "params": params or dict(),
+            "peak_rss_mb": peak_rss_mb(),
+            # the peaks of the workers are reset by their stages
+            "peak_rss_children_mb": max(
+                [peak_rss_mb(children=True)]
+                + [s["peak_rss_mb"] for s in self.stages if s["pid"] != os.getpid()]
+            ),
+            "summary": self.summary(),
+            "stages": self.stages,
+        }
+        with open(profile_file, "w") as f:
+            json.dump(profile, f, indent=2, default=str)
+
+
+def stage(profiler: StageProfiler, name: str, **info):
+    """Profile a stage if `profiler` is given, do nothing otherwise."""
+
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name, **info)
@@ -0,0 +1,85 @@
+import itertools
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+
+from clustering import (
+    add_clustering_args,
+    get_results_dir,
+    load_inputs,
+    preprocess_inputs,
+    run_clustering,
+)
+from profiling import StageProfiler
+
+# Run `clustering.py` over a grid of configurations in a single process.
+# The predictions, the tracks table and the AV trajectories are loaded once, and the
+# preprocessed trajectories are shared by the configurations that only differ in the
+# genre threshold or the number of samples per genre.
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description="Run the genre clustering for every combination of the given values."
+    )
+    parser.add_argument("--genre-threshold", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--n-samples-per-genre", type=int, nargs="+", default=[200])
+    parser.add_argument("--smoothing-sigma", type=int, nargs="+", default=[5])
+    parser.add_argument("--decimate-factor", type=int, nargs="+", default=[5])
+    parser.add_argument(
+        "--norm",
+        type=str,
+        nargs="+",
+        default=["none"],
+        choices=["none", "minmax", "zscore"],
+    )
+    add_clustering_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    data_dir = Path("data/")
+
+    # preprocessing configurations first, so that each one is computed once
+    grid = list(
+        itertools.product(
+            args.smoothing_sigma,
+            args.decimate_factor,
+            args.norm,
+            args.genre_threshold,
+            args.n_samples_per_genre,
+        )
+    )
+    print(f"Sweeping {len(grid)} configurations.")
+
+    # the loading stages are reported in the profile of every configuration
+    load_profiler = StageProfiler()
+    inputs = load_inputs(args, data_dir, load_profiler)
+
+    data_av_decimated = None
+    preprocessing = None
+    for sigma, factor, norm, threshold, n_samples in grid:
+        config = Namespace(
+            **dict(
+                vars(args),
+                smoothing_sigma=sigma,
+                decimate_factor=factor,
+                norm=norm,
+                genre_threshold=threshold,
+                n_samples_per_genre=n_samples,
+            )
+        )
+        print(f"Running {get_results_dir(config, data_dir)}")
+        profiler = StageProfiler(list(load_profiler.stages))
+
+        if (sigma, factor, norm) != preprocessing:
+            data_av_decimated = preprocess_inputs(config, inputs, profiler)
+            preprocessing = (sigma, factor, norm)
+
+        run_clustering(config, inputs, data_av_decimated, data_dir, profiler)
+
+    print("done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import csv
+import json
+from argparse import ArgumentParser
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+# Array-backed version of the MTG Jamendo autotagging metadata.
+# `commons.read_file` builds a dict of dicts with per-track tag lists and sets, which
+# is slow to parse and expensive to hash or copy in the streamlit caches. The table
+# is parsed once into memory-mappable `.npy` columns with a CSR-style tag index.
+
+AUTOTAGGING_FILE = Path("mtg-jamendo-dataset/data/autotagging.tsv")
+TRACKS_TABLE_DIR = Path("data/tracks_table/")
+
+COLUMNS = ("tid", "artist_id", "album_id", "duration", "path", "tag_offsets", "tag_ids")
+META_FILE = "meta.json"
+
+# tag categories of the MTG Jamendo dataset, as in `commons.CATEGORIES`
+CATEGORIES = ("genre", "instrument", "mood/theme")
+TAG_HYPHEN = "---"
+
+# length of the audio played by the apps, in seconds
+AUDIO_PREVIEW_SECONDS = 120
+
+
+def get_id(value: str) -> int:
+    """Parse an MTG Jamendo id such as `track_0000214`."""
+
+    return int(value.split("_")[1])
+
+
+def source_stamp(autotagging_file: Path) -> dict:
+    """Identify a version of the autotagging file."""
+
+    stat = Path(autotagging_file).stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def build_tracks_table(
+    autotagging_file: Path = AUTOTAGGING_FILE,
+    table_dir: Path = TRACKS_TABLE_DIR,
+) -> None:
+    """Parse the autotagging TSV into the array-backed table."""
+
+    rows = []
+    with open(autotagging_file) as f:
+        reader = csv.reader(f, delimiter="\t")
+        next(reader, None)  # skip header
+        for row in reader:
+            rows.append(row)
+    rows.sort(key=lambda row: get_id(row[0]))
+
+    tag_names = sorted({tag for row in rows for tag in row[5:]})
+    tag_index = {tag: i for i, tag in enumerate(tag_names)}
+
+    n_tags = np.array([len(row) - 5 for row in rows], dtype=np.int64)
+    tag_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    tag_offsets[1:] = np.cumsum(n_tags)
+
+    columns = {
+        "tid": np.array([get_id(row[0]) for row in rows], dtype=np.int64),
+        "artist_id": np.array([get_id(row[1]) for row in rows], dtype=np.int64),
+        "album_id": np.array([get_id(row[2]) for row in rows], dtype=np.int64),
+        "path": np.array([row[3] for row in rows], dtype=np.str_),
+        "duration": np.array([float(row[4]) for row in rows], dtype=np.float64),
+        "tag_offsets": tag_offsets,
+        "tag_ids": np.array(
+            [tag_index[tag] for row in rows for tag in row[5:]], dtype=np.int32
+        ),
+    }
+
+    table_dir = Path(table_dir)
+    table_dir.mkdir(parents=True, exist_ok=True)
+    for name in COLUMNS:
+        np.save(table_dir / f"{name}.npy", columns[name])
+
+    # write the metadata last, it marks the table as complete
+    with open(table_dir / META_FILE, "w") as f:
+        json.dump(
+            {"tag_names": tag_names, "source": source_stamp(autotagging_file)}, f
+        )
+
+    print(f"Wrote {len(rows)} tracks to {table_dir}")
+
+
+class TracksTable(Mapping):
+    """Read-only, memory-mapped tracks table.
+
+    Behaves like the `tracks` dict returned by `commons.read_file`:
+    `tracks[tid]` returns a dict with `artist_id`, `album_id`, `path`, `duration`,
+    `tags` and the per-category tag sets. Use the column accessors (`album_ids`,
+    `durations`, ...) for vectorized lookups.
+    """
+
+    def __init__(self, table_dir: Path = TRACKS_TABLE_DIR):
+        self.table_dir = Path(table_dir)
+
+        for name in COLUMNS:
+            setattr(self, name, np.load(self.table_dir / f"{name}.npy", mmap_mode="r"))
+
+        with open(self.table_dir / META_FILE, "r") as f:
+            self.tag_names = json.load(f)["tag_names"]
+
+    def __reduce__(self):
+        # pickle (e.g. for the streamlit caches) as a reference to the table directory
+        return (self.__class__, (self.table_dir,))
+
+    def __len__(self) -> int:
+        return len(self.tid)
+
+    def __iter__(self):
+        return iter(self.tid.tolist())
+
+    def __contains__(self, tid) -> bool:
+        if not isinstance(tid, (int, np.integer)):
+            return False
+        try:
+            self.rows([tid])
+        except KeyError:
+            return False
+        return True
+
+    def rows(self, tids) -> np.ndarray:
+        """Return the row indices of a list of tids."""
+
+        tids = np.asarray(tids, dtype=np.int64)
+        rows = np.searchsorted(self.tid, tids)
+        rows_clipped = np.minimum(rows, len(self.tid) - 1)
+        found = self.tid[rows_clipped] == tids
+        if not np.all(found):
+            raise KeyError(tids[~found].tolist())
+
+        return rows
+
+    def tags(self, row: int) -> list:
+        """Return the raw tags (`category---tag`) of a row."""
+
+        start, end = self.tag_offsets[row], self.tag_offsets[row + 1]
+        return [self.tag_names[i] for i in self.tag_ids[start:end]]
+
+    def __getitem__(self, tid) -> dict:
+        if tid not in self:
+            raise KeyError(tid)
+
+        row = self.rows([tid])[0]
+
+        tags = self.tags(row)
+        track = {
+            "artist_id": int(self.artist_id[row]),
+            "album_id": int(self.album_id[row]),
+            "path": str(self.path[row]),
+            "duration": float(self.duration[row]),
+            "tags": tags,
+        }
+        track.update({category: set() for category in CATEGORIES})
+        for tag_str in tags:
+            category, tag = tag_str.split(TAG_HYPHEN)
+            track.setdefault(category, set()).update(tag.split(","))
+
+        return track
+
+    def album_ids(self, tids) -> np.ndarray:
+        """Return the album ids of a list of tids."""
+
+        return np.asarray(self.album_id[self.rows(tids)])
+
+    def artist_ids(self, tids) -> np.ndarray:
+        """Return the artist ids of a list of tids."""
+
+        return np.asarray(self.artist_id[self.rows(tids)])
+
+    def durations(self, tids) -> np.ndarray:
+        """Return the durations in seconds of a list of tids."""
+
+        return np.asarray(self.duration[self.rows(tids)])
+
+
+def load_tracks(
+    autotagging_file: Path = AUTOTAGGING_FILE,
+    table_dir: Path = TRACKS_TABLE_DIR,
+) -> TracksTable:
+    """Load the tracks table, (re)building it if the autotagging file changed."""
+
+    table_dir = Path(table_dir)
+    meta_file = table_dir / META_FILE
+
+    up_to_date = False
+    if meta_file.exists():
+        with open(meta_file, "r") as f:
+            up_to_date = json.load(f)["source"] == source_stamp(autotagging_file)
+
+    if not up_to_date:
+        print(f"Building the tracks table from {autotagging_file}")
+        build_tracks_table(autotagging_file, table_dir)
+
+    return TracksTable(table_dir)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Build the array-backed tracks table from the autotagging TSV."
+    )
+    parser.add_argument("--autotagging-file", type=Path, default=AUTOTAGGING_FILE)
+    parser.add_argument("--table-dir", type=Path, default=TRACKS_TABLE_DIR)
+    args = parser.parse_args()
+
+    build_tracks_table(args.autotagging_file, args.table_dir)
@@ -1,36 +1,142 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-import matplotlib.pyplot as plt
 import numpy as np
 import streamlit as st
-from matplotlib.dates import DateFormatter
 import re
 
 from scipy.ndimage import gaussian_filter1d
 from scipy.signal import decimate
 
+from av_store import (
+    AV_PREDICTIONS_DIR,
+    PREPROCESSED_CACHE_DIR,
+    av_data_version,
+    av_source_version,
+    has_av_store,
+    load_av_store,
+    load_cached_av_data,
+    packed_store_dir,
+    read_av_store_meta,
+)
+from profiling import StageProfiler, stage
+from tracks_table import AUDIO_PREVIEW_SECONDS
+
+
+def throttle(callback, max_rate: float = 4.0):
+    """Wrap a `callback(n_done, n_total)` so it fires at most `max_rate` times per second.
+
+    The final call (`n_done == n_total`) is always forwarded.
+    """
+
+    min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+    last_call = -np.inf
+
+    def throttled(n_done: int, n_total: int) -> None:
+        nonlocal last_call
+
+        now = time.monotonic()
+        if n_done >= n_total or now - last_call >= min_interval:
+            last_call = now
+            callback(n_done, n_total)
+
+    return throttled
+
+
+def _load_av_file(av_filename: Path) -> np.ndarray:
+    """Load and normalize a single time-wise AV prediction file."""
+
+    array = np.load(av_filename)
+    if array.ndim != 2 or array.shape[1] != 2:
+        raise ValueError(f"unexpected shape {array.shape}")
+
+    return (array - 5) / 4
+
 
 def load_av_time_data(
     tids: set,
     tracks: dict,
-    av_predictions_dir: Path = Path("data/predictions/emomusic-msd-musicnn-2/"),
-) -> tuple[dict, set]:
-    """Load and prepare time-wise arousal and valence data in the streamlit cache."""
+    av_predictions_dir: Path = AV_PREDICTIONS_DIR,
+    store_dir: Path = None,
+    n_workers: int = 16,
+    progress_callback=None,
+    max_progress_rate: float = 4.0,
+) -> tuple[dict, dict]:
+    """Load and prepare time-wise arousal and valence data in the streamlit cache.
+
+    Reads from the packed store in `store_dir` (by default next to
+    `av_predictions_dir`, see `av_store.py`) when it exists, and the tids missing from
+    the store from the per-track `.npy` files, using a pool of `n_workers` threads.
+
+    `progress_callback(n_done, n_total)` is called from the calling thread at most
+    `max_progress_rate` times per second.
+
+    Returns the loaded data and a report with the `missing` tids (no track entry or
+    no prediction file), the `corrupt` ones (mapped to the loading error) and the
+    `version` of the loaded data, which hashes only the trajectories read from files.
+    """
 
-    data_av_time = dict()
     tids_list = list(tids)
-    for index in tids_list:
-        try:
-            av_filename = (av_predictions_dir / tracks[index]["path"]).with_suffix(
-                ".npy"
-            )
-            # load and normalize
-            array = np.load(av_filename)
-            data_av_time[index] = (array - 5) / 4
+    report = {"missing": [], "corrupt": dict()}
+
+    if progress_callback is not None:
+        progress_callback = throttle(progress_callback, max_progress_rate)
 
-        except Exception:
-            pass
+    if store_dir is None:
+        store_dir = packed_store_dir(av_predictions_dir)
 
-    return data_av_time, set(tids_list)
+    data_av_time = dict()
+    store_version = None
+    if has_av_store(store_dir):
+        data_av_time = load_av_store(store_dir, tids_list)
+        store_version = read_av_store_meta(store_dir)["version"]
+    tids_store = list(data_av_time)
+
+    # tids of a partial or outdated store are read from their files
+    tids_files = [tid for tid in tids_list if tid not in data_av_time]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = dict()
+        for tid in tids_files:
+            if tid not in tracks:
+                report["missing"].append(tid)
+                continue
+
+            av_filename = (av_predictions_dir / tracks[tid]["path"]).with_suffix(".npy")
+            futures[executor.submit(_load_av_file, av_filename)] = tid
+
+        n_done = len(data_av_time) + len(report["missing"])
+        for future in as_completed(futures):
+            tid = futures[future]
+            try:
+                data_av_time[tid] = future.result()
+            except FileNotFoundError:
+                report["missing"].append(tid)
+            except Exception as e:
+                report["corrupt"][tid] = repr(e)
+
+            n_done += 1
+            if progress_callback is not None:
+                progress_callback(n_done, len(tids_list))
+
+    if progress_callback is not None and not futures:
+        progress_callback(len(tids_list), len(tids_list))
+
+    data_files = {tid: data_av_time[tid] for tid in tids_files if tid in data_av_time}
+    report["version"] = av_source_version(store_version, tids_store, data_files)
+
+    return data_av_time, report
+
+
+def print_av_load_report(data_av_time: dict, report: dict) -> None:
+    """Print a summary of a `load_av_time_data` report."""
+
+    print(
+        f"Loaded {len(data_av_time)} AV trajectories, "
+        f"{len(report['missing'])} missing, {len(report['corrupt'])} corrupt."
+    )
+    for tid, error in report["corrupt"].items():
+        print(f" corrupt AV data for track {tid}: {error}")
 
 
 def smooth_data(data: dict, sigma: int = 5) -> dict:
@@ -40,15 +146,124 @@ def smooth_data(data: dict, sigma: int = 5) -> dict:
 
 
 def decimate_data(data: dict, factor: int = 5) -> dict:
-    """Downsample data using ."""
+    """Downsample data using an order 8 Chebyshev type I filter."""
 
     return {k: decimate(sample, factor, axis=0) for k, sample in data.items()}
 
 
+def bucket_by_length(data: dict) -> list:
+    """Group trajectories of equal length into float32 batches.
+
+    Returns a list of `(tids, batch)` tuples where `batch` has shape
+    `(len(tids), length, n_dims)`.
+    """
+
+    buckets = dict()
+    for k, sample in data.items():
+        buckets.setdefault(len(sample), []).append(k)
+
+    return [
+        (tids, np.stack([data[k] for k in tids]).astype(np.float32, copy=False))
+        for tids in buckets.values()
+    ]
+
+
+def smooth_data_batched(data: dict, sigma: int = 5) -> dict:
+    """Smooth data using a gaussian filter, one SciPy call per trajectory length.
+
+    Gives the same result as `smooth_data` in float32.
+    """
+
+    smoothed = dict()
+    for tids, batch in bucket_by_length(data):
+        smoothed.update(zip(tids, gaussian_filter1d(batch, sigma, axis=1)))
+
+    return {k: smoothed[k] for k in data}
+
+
+def decimate_data_batched(data: dict, factor: int = 5) -> dict:
+    """Downsample data, one SciPy call per trajectory length.
+
+    Gives the same result as `decimate_data` in float32.
+    """
+
+    decimated = dict()
+    for tids, batch in bucket_by_length(data):
+        batch = decimate(batch, factor, axis=1).astype(np.float32)
+        decimated.update(zip(tids, batch))
+
+    return {k: decimated[k] for k in data}
+
+
+def normalize_data(data: dict, norm_type: str = "none") -> dict:
+    """Normalize each trajectory independently.
+
+    Only `zscore` changes the data, other values are accepted for compatibility
+    with the `--norm` choices of `clustering.py`.
+    """
+
+    if norm_type == "zscore":
+        return {k: (v - v.mean(axis=0)) / v.std(axis=0) for k, v in data.items()}
+
+    return data
+
+
+def preprocess_av_data(
+    data: dict,
+    sigma: int = 5,
+    factor: int = 5,
+    norm_type: str = "none",
+    cache_dir: Path = PREPROCESSED_CACHE_DIR,
+    profiler: StageProfiler = None,
+    source_version: str = None,
+) -> dict:
+    """Smooth, decimate and normalize AV trajectories.
+
+    Results are cached on disk keyed by the version of the input data and the
+    preprocessing parameters. Set `cache_dir` to `None` to disable the cache.
+    `source_version` is the version reported by `load_av_time_data`, the data is
+    hashed if it is not given.
+    """
+
+    def smooth_and_decimate():
+        with stage(profiler, "smooth"):
+            data_smoothed = smooth_data_batched(data, sigma)
+        with stage(profiler, "decimate"):
+            return decimate_data_batched(data_smoothed, factor)
+
+    def normalize(data_decimated):
+        with stage(profiler, "normalize"):
+            return normalize_data(data_decimated, norm_type)
+
+    if cache_dir is None:
+        return normalize(smooth_and_decimate())
+
+    params = {
+        "source_version": source_version or av_data_version(data),
+        "smoothing_sigma": sigma,
+        "decimate_factor": factor,
+        "norm": "none",
+    }
+    # smoothing and decimation are shared by all the normalizations
+    data_decimated = load_cached_av_data(params, smooth_and_decimate, cache_dir)
+    # the other normalizations leave the data unchanged, see `normalize_data`
+    if norm_type != "zscore":
+        return data_decimated
+
+    return load_cached_av_data(
+        dict(params, norm=norm_type),
+        lambda: normalize(data_decimated),
+        cache_dir,
+    )
+
+
 def audio_url(trackid) -> str:
     """Return the Jamendo URL for a given trackid."""
 
-    return f"https://mp3d.jamendo.com/?trackid={trackid}&format=mp32#t=0,120"
+    return (
+        f"https://mp3d.jamendo.com/?trackid={trackid}&format=mp32"
+        f"#t=0,{AUDIO_PREVIEW_SECONDS}"
+    )
 
 
 def play(tid: str, tracks: dict, autoplay: bool = False) -> None:
@@ -160,6 +375,9 @@ def plot_av(
 ) -> None:
     """Plot the arousal and valence curves for a given track id."""
 
+    import matplotlib.pyplot as plt
+    from matplotlib.dates import DateFormatter
+
     formatter = DateFormatter("%M'%S''")
 
     emb2days = 63 * 256 / (16000 * 3600 * 24)